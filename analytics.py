@@ -0,0 +1,137 @@
+import logging
+import threading
+from datetime import date
+
+from database import IdWatermark
+
+try:
+    import numpy as np
+except ImportError:  # NumPy es opcional: sin él la vista de analíticas lo indica
+    np = None
+
+logger = logging.getLogger(__name__)
+
+
+def revenue_report(rows):
+    """Ingresos por mes y tipo de pago y tasa de aprobación a partir de stats_revenue_monthly.
+
+    Las filas se pasan a columnas y todo el cálculo es vectorizado, así que un
+    informe de varios años cuesta lo mismo que uno de un mes. Devuelve None si
+    NumPy no está instalado o no hay datos.
+    """
+    if np is None or not rows:
+        return None
+    months_column = np.array([row['month'] for row in rows], dtype='datetime64[M]')
+    types_column = np.array([row['payment_type'] for row in rows])
+    approved_amount = np.array([row['approved_amount'] for row in rows], dtype=float)
+    approved_count = np.array([row['approved_count'] for row in rows], dtype=float)
+    rejected_count = np.array([row['rejected_count'] for row in rows], dtype=float)
+    pending_count = np.array([row['pending_count'] for row in rows], dtype=float)
+
+    months, month_index = np.unique(months_column, return_inverse=True)
+    payment_types, type_index = np.unique(types_column, return_inverse=True)
+    revenue = np.zeros((len(months), len(payment_types)))
+    np.add.at(revenue, (month_index, type_index), approved_amount)
+
+    def per_month(values):
+        return np.bincount(month_index, weights=values, minlength=len(months))
+
+    approved = per_month(approved_count)
+    rejected = per_month(rejected_count)
+    pending = per_month(pending_count)
+    decided = approved + rejected
+    approval_rate = np.divide(approved, decided, out=np.full(len(months), np.nan), where=decided > 0)
+    total_decided = decided.sum()
+    return {
+        'months': [str(month) for month in months],
+        'payment_types': [str(payment_type) for payment_type in payment_types],
+        'revenue': revenue,
+        'total_revenue': revenue.sum(axis=1),
+        'revenue_by_type': revenue.sum(axis=0),
+        'approved': approved,
+        'rejected': rejected,
+        'pending': pending,
+        'approval_rate': approval_rate,
+        'overall_approval_rate': approved.sum() / total_decided if total_decided else float('nan'),
+    }
+
+
+# Cortes de la distribución de visitas por socio
+VISIT_FREQUENCY_BINS = [1, 2, 3, 5, 9, 13, 21]
+VISIT_FREQUENCY_LABELS = ["1", "2", "3-4", "5-8", "9-12", "13-20", "21+"]
+WEEKDAY_NAMES = ["Lun", "Mar", "Mié", "Jue", "Vie", "Sáb", "Dom"]
+
+
+def _to_days(day):
+    # Equivalente de TO_DAYS() de MySQL
+    return day.toordinal() + 365
+
+
+class AttendanceAnalytics:
+    """Columnas de la tabla attendances en memoria para las analíticas de ocupación.
+
+    La primera llamada a ``refresh`` lee la tabla completa una sola vez; las
+    siguientes solo las asistencias con id mayor que la última vista (más las
+    de lotes que confirmaron tarde, ver IdWatermark), así que los check-ins
+    nuevos se suman sin volver a leer el resto. Con 2 millones de asistencias
+    las columnas ocupan unos 20 MB.
+    """
+
+    def __init__(self, gap_grace=600.0):
+        self._watermark = IdWatermark(grace=gap_grace)
+        self._user_ids = None
+        self._days = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    def refresh(self, load_chunks):
+        """Añade las asistencias nuevas. ``load_chunks(after_id, missing_ids=...)`` devuelve bloques
+        de filas (id, user_id, día, franja) en orden de id, como CommonApp.iter_attendance_chunks."""
+        if np is None:
+            return
+        # La lectura va dentro del bloqueo: dos sesiones a la vez no pueden añadir las mismas filas
+        with self._lock:
+            watermark = self._watermark
+            new_columns = [np.array(rows, dtype=np.int64).reshape(-1, 4)
+                           for rows in load_chunks(watermark.last_id, missing_ids=watermark.missing_ids())]
+            block = np.concatenate(new_columns) if new_columns else np.empty((0, 4), dtype=np.int64)
+            watermark.advance(block[:, 0])
+            if not len(block):
+                return
+            parts = [(self._user_ids, block[:, 1].astype(np.int32)),
+                     (self._days, block[:, 2].astype(np.int32)),
+                     (self._slots, block[:, 3].astype(np.int16))]
+            self._user_ids, self._days, self._slots = [
+                new if old is None else np.concatenate([old, new]) for old, new in parts]
+            logger.info(f"Analíticas de asistencia: {len(block)} asistencias nuevas, {len(self._days)} en total")
+
+    def report(self, weeks=4, today=None):
+        """Mapa de calor día × hora y distribución de visitas por socio de las últimas ``weeks`` semanas."""
+        if np is None:
+            return None
+        with self._lock:
+            user_ids, days, slots = self._user_ids, self._days, self._slots
+        if days is None:
+            return None
+        start = _to_days(today or date.today()) - weeks * 7
+        in_window = days > start
+        window_slots = slots[in_window]
+        heatmap = np.bincount(window_slots[window_slots >= 0], minlength=7 * 24).reshape(7, 24)
+
+        visits_per_member = np.bincount(user_ids[in_window])
+        visits_per_member = visits_per_member[visits_per_member > 0]
+        edges = VISIT_FREQUENCY_BINS + [max(VISIT_FREQUENCY_BINS[-1], int(visits_per_member.max(initial=0))) + 1]
+        distribution, _ = np.histogram(visits_per_member, bins=edges)
+        return {
+            'weeks': weeks,
+            'heatmap': heatmap,
+            'total_visits': int(in_window.sum()),
+            'visits_without_time': int((window_slots < 0).sum()),
+            'active_members': int(len(visits_per_member)),
+            'mean_visits': float(visits_per_member.mean()) if len(visits_per_member) else 0.0,
+            'frequency_labels': VISIT_FREQUENCY_LABELS,
+            'frequency_distribution': distribution,
+        }
+
+
+attendance_analytics = AttendanceAnalytics()
@@ -0,0 +1,445 @@
+import argparse
+import asyncio
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+import mysql.connector
+
+import common
+import migrations
+from client_app import ClientApp
+from owner_app import OwnerApp
+from passwords import PasswordHasher
+from instrumentation import query_metrics
+
+# Tamaño por defecto del conjunto de datos sintético
+DEFAULT_SIZES = {
+    'users': 20000,
+    'attendances': 2000000,
+    'payments': 200000,
+    'notifications': 500000,
+    'promotions': 20,
+}
+
+SEED_TABLES = ['app_events', 'image_blobs', 'notifications', 'attendances', 'payments', 'promotions', 'users',
+               'stats_counters', 'stats_daily_attendance', 'stats_membership_expiry', 'stats_revenue_monthly',
+               'scheduled_jobs']
+
+# Horas de llegada al gimnasio: picos por la mañana temprano y al salir del trabajo
+CHECKIN_HOURS = list(range(5, 23))
+CHECKIN_HOUR_WEIGHTS = [2, 6, 8, 6, 4, 3, 3, 4, 3, 2, 3, 5, 8, 9, 8, 5, 3, 1]
+
+MEMBERSHIP_DAYS = {'normal': 15, 'full': 30}
+
+# Las fechas de los datos se calculan desde este día y no desde hoy: la misma semilla da los mismos datos
+REFERENCE_DATE = date(2025, 1, 1)
+
+# Métodos que escriben: se miden con dry_run para que su transacción se deshaga y no altere los datos
+WRITE_METHODS = {'record_attendance', 'mark_notifications_as_read'}
+
+
+class BenchmarkSession:
+    def __init__(self):
+        self._values = {}
+
+    def set(self, key, value):
+        self._values[key] = value
+
+    def get(self, key):
+        return self._values.get(key)
+
+    def contains_key(self, key):
+        return key in self._values
+
+    def remove(self, key):
+        self._values.pop(key, None)
+
+
+class BenchmarkPage:
+    """Lo mínimo de ft.Page que usan las vistas, sin cliente conectado: update/go no hacen nada."""
+
+    def __init__(self, route="/"):
+        self.route = route
+        self.views = []
+        self.overlay = []
+        self.dialog = None
+        self.session = BenchmarkSession()
+
+    def update(self, *controls):
+        pass
+
+    async def update_async(self, *controls):
+        pass
+
+    def show_snack_bar(self, snack_bar):
+        pass
+
+    def go(self, route):
+        self.route = route
+
+    async def go_async(self, route):
+        self.route = route
+
+
+def count_controls(control):
+    if control is None:
+        return 0
+    # Hijos directos: listas de controles (Row, Column, View...) y contenido único (Container, GestureDetector...)
+    children = list(getattr(control, 'controls', None) or [])
+    content = getattr(control, 'content', None)
+    if content is not None and not isinstance(content, str):
+        children.append(content)
+    return 1 + sum(count_controls(child) for child in children)
+
+
+def measure(fn, repeat):
+    """Ejecuta ``fn`` ``repeat`` veces y devuelve tiempos en milisegundos y filas del último resultado."""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return summarize(timings, result)
+
+
+async def measure_async(fn, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = await fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return summarize(timings, result)
+
+
+def summarize(timings, result):
+    ordered = sorted(timings)
+    summary = {
+        'runs': len(timings),
+        'min_ms': round(ordered[0], 3),
+        'median_ms': round(statistics.median(ordered), 3),
+        'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+        'max_ms': round(ordered[-1], 3),
+    }
+    if isinstance(result, (list, tuple)):
+        summary['rows'] = len(result)
+    return summary
+
+
+def use_database(database):
+    common.db_config['database'] = database
+
+
+def create_database(database):
+    config = {key: value for key, value in common.db_config.items() if key != 'database'}
+    conn = mysql.connector.connect(**config)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{database}`")
+        cursor.close()
+    finally:
+        conn.close()
+
+
+def insert_batches(app, query, rows, batch_size):
+    batch = []
+    total = 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            with app.db_cursor() as cursor:
+                cursor.executemany(query, batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        with app.db_cursor() as cursor:
+            cursor.executemany(query, batch)
+        total += len(batch)
+    return total
+
+
+def seed(app, args):
+    """Crea el esquema y lo llena con datos sintéticos reproducibles (misma semilla = mismos datos)."""
+    rng = random.Random(args.seed)
+    sizes = {name: getattr(args, name) for name in DEFAULT_SIZES}
+    today = args.reference_date
+    migrations.migrate(app)
+
+    with app.db_cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) AS total FROM users")
+        if cursor.fetchone()['total'] and not args.reset:
+            print("La base de datos ya tiene usuarios; usa --reset para vaciarla")
+            return
+        cursor.execute("SET FOREIGN_KEY_CHECKS = 0")
+        for table in SEED_TABLES:
+            cursor.execute(f"TRUNCATE TABLE {table}")
+        cursor.execute("SET FOREIGN_KEY_CHECKS = 1")
+
+    started = time.perf_counter()
+    # Coste mínimo de bcrypt: el benchmark mide consultas, no el login
+    hasher = PasswordHasher(workers=1, rounds=4)
+    try:
+        password = asyncio.run(hasher.hash("benchmark"))
+    finally:
+        hasher.shutdown()
+
+    def users():
+        for i in range(sizes['users']):
+            membership_type = rng.choice(list(MEMBERSHIP_DAYS))
+            start_date = today - timedelta(days=rng.randint(0, 60))
+            end_date = start_date + timedelta(days=MEMBERSHIP_DAYS[membership_type])
+            yield (f"socio{i:06d}", password, membership_type, start_date, end_date,
+                   rng.randint(0, MEMBERSHIP_DAYS[membership_type]))
+
+    insert_batches(app, "INSERT INTO users (username, password, membership_type, membership_start_date, "
+                        "membership_end_date, remaining_days) VALUES (%s, %s, %s, %s, %s, %s)",
+                   users(), args.batch_size)
+    with app.db_cursor() as cursor:
+        cursor.execute("SELECT MIN(id) AS first_id, MAX(id) AS last_id FROM users")
+        bounds = cursor.fetchone()
+    first_id, last_id = bounds['first_id'], bounds['last_id']
+
+    def member():
+        # Algunos socios vienen mucho más que otros
+        return first_id + min(int(rng.paretovariate(1.2)) - 1, last_id - first_id)
+
+    def attendances():
+        for _ in range(sizes['attendances']):
+            day = today - timedelta(days=rng.randint(0, 364))
+            hour = rng.choices(CHECKIN_HOURS, CHECKIN_HOUR_WEIGHTS)[0]
+            yield (rng.randint(first_id, last_id) if rng.random() < 0.7 else member(), day,
+                   datetime(day.year, day.month, day.day, hour, rng.randint(0, 59)))
+
+    def payments():
+        for i in range(sizes['payments']):
+            payment_type = rng.choice(list(MEMBERSHIP_DAYS))
+            status = rng.choices(['approved', 'rejected', 'pending'], [85, 10, 5])[0]
+            yield (rng.randint(first_id, last_id), MEMBERSHIP_DAYS[payment_type],
+                   today - timedelta(days=rng.randint(0, 3 * 365)), payment_type,
+                   f"payment_images/recibo_{i}.png", status)
+
+    def notifications():
+        end_of_day = datetime(today.year, today.month, today.day, 23, 59)
+        for _ in range(sizes['notifications']):
+            sent_at = end_of_day - timedelta(minutes=rng.randint(0, 180 * 24 * 60))
+            yield (rng.randint(first_id, last_id), f"Tu membresía expira el {sent_at.date()}",
+                   sent_at.replace(microsecond=0), int(rng.random() < 0.8))
+
+    def promotions():
+        for i in range(sizes['promotions']):
+            yield (f"Promoción {i}", "Descuento para socios", f"promotion_images/promo_{i}.png")
+
+    insert_batches(app, "INSERT INTO attendances (user_id, attendance_date, attended_at) VALUES (%s, %s, %s)",
+                   attendances(), args.batch_size)
+    insert_batches(app, "INSERT INTO payments (user_id, amount, payment_date, payment_type, image_path, status) "
+                        "VALUES (%s, %s, %s, %s, %s, %s)", payments(), args.batch_size)
+    insert_batches(app, "INSERT INTO notifications (user_id, message, sent_at, is_read) VALUES (%s, %s, %s, %s)",
+                   notifications(), args.batch_size)
+    insert_batches(app, "INSERT INTO promotions (title, description, image_path) VALUES (%s, %s, %s)",
+                   promotions(), args.batch_size)
+    app.rebuild_statistics()
+    print(f"Datos generados en {time.perf_counter() - started:.1f} s: "
+          + ", ".join(f"{name}={total}" for name, total in sizes.items()))
+
+
+def dataset_sizes(app):
+    with app.db_cursor() as cursor:
+        sizes = {}
+        for table in ('users', 'attendances', 'payments', 'notifications', 'promotions'):
+            cursor.execute(f"SELECT COUNT(*) AS total FROM {table}")
+            sizes[table] = cursor.fetchone()['total']
+    return sizes
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_methods(app, repeat, rng, today):
+    with app.db_cursor() as cursor:
+        # El socio con más asistencias es el peor caso del historial
+        cursor.execute("SELECT user_id FROM attendances GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1")
+        busiest_user = cursor.fetchone()['user_id']
+        cursor.execute("SELECT MIN(id) AS first_id, MAX(id) AS last_id FROM users")
+        bounds = cursor.fetchone()
+    month_start = today.replace(day=1)
+    some_users = [rng.randint(bounds['first_id'], bounds['last_id']) for _ in range(repeat)]
+    checkin_users = iter(some_users)
+    notification_users = iter(some_users)
+
+    methods = {
+        'get_statistics': lambda: app.get_statistics(),
+        'get_users (página por id)': lambda: app.get_users(limit=app.users_page_size),
+        'get_users (página por nombre)': lambda: app.get_users(limit=app.users_page_size, order_by="username"),
+        'get_pending_payments': lambda: app.get_pending_payments(),
+        'get_payment_history (completo)': lambda: app.get_payment_history(),
+        'get_payment_history (página)': lambda: app.get_payment_history(limit=app.payments_page_size),
+        'get_payment_history (filtrado)': lambda: app.get_payment_history(
+            filters={'status': 'approved', 'date_from': month_start - timedelta(days=90), 'date_to': month_start},
+            limit=app.payments_page_size),
+        'get_revenue_rollup': lambda: app.get_revenue_rollup(),
+        'get_attendance_history (completo)': lambda: app.get_attendance_history(busiest_user),
+        'get_attendance_history (página)': lambda: app.get_attendance_history(busiest_user, limit=30),
+        'get_monthly_attendance_counts': lambda: app.get_monthly_attendance_counts(busiest_user),
+        'get_remaining_days': lambda: app.get_remaining_days(busiest_user),
+        'get_unread_notifications': lambda: app.get_unread_notifications(busiest_user),
+        'get_notifications (página)': lambda: app.get_notifications(busiest_user),
+        'get_unread_count': lambda: app.get_unread_count(busiest_user),
+        'get_promotions': lambda: app.get_promotions(),
+        'get_cached_promotions': lambda: app.get_cached_promotions(),
+        'get_attendance_analytics': lambda: app.get_attendance_analytics(),
+        'record_attendance': lambda: app.record_attendance(next(checkin_users)),
+        'mark_notifications_as_read': lambda: app.mark_notifications_as_read(next(notification_users)),
+    }
+    results = {}
+    for name, fn in methods.items():
+        app.dry_run = name in WRITE_METHODS
+        try:
+            results[name] = measure(fn, repeat)
+        finally:
+            app.dry_run = False
+        print(f"{name:<40} {results[name]['median_ms']:>10.2f} ms")
+    return results, busiest_user
+
+
+async def benchmark_views(owner, client, user_id, repeat):
+    client.current_user = client.get_user_by_id(user_id)
+    results = {}
+
+    async def client_dashboard(page):
+        view = await client.dashboard_view(page)
+        await page.session.get("dashboard_fill_task")  # secciones cargadas en segundo plano
+        client.unsubscribe_events(page)
+        return view
+
+    views = {
+        'owner.dashboard_view': lambda page: owner.dashboard_view(page),
+        'owner.manage_users_view': lambda page: owner.manage_users_view(page),
+        'owner.manage_payments_view': lambda page: owner.manage_payments_view(page),
+        'owner.payment_history_view': lambda page: owner.payment_history_view(page),
+        'owner.analytics_view': lambda page: owner.analytics_view(page),
+        'client.dashboard_view': client_dashboard,
+        'client.view_promotions': lambda page: client.view_promotions(page),
+    }
+    for name, build in views.items():
+        built = []
+
+        async def build_once():
+            page = BenchmarkPage()
+            built.append(await build(page))
+
+        results[name] = await measure_async(build_once, repeat)
+        results[name]['controls'] = count_controls(built[-1])
+        print(f"{name:<40} {results[name]['median_ms']:>10.2f} ms {results[name]['controls']:>8} controles")
+    return results
+
+
+def run(app, args):
+    rng = random.Random(args.seed)
+    owner = OwnerApp()
+    client = ClientApp()
+    report = {
+        'meta': {
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': common.db_config['database'],
+            'repeat': args.repeat,
+            'seed': args.seed,
+            'reference_date': args.reference_date.isoformat(),
+            'dataset': dataset_sizes(app),
+        },
+    }
+    query_metrics.reset()  # solo las consultas de las mediciones, no las del recuento del dataset
+    report['methods'], busiest_user = benchmark_methods(owner, args.repeat, rng, args.reference_date)
+    report['views'] = asyncio.run(benchmark_views(owner, client, busiest_user, args.repeat))
+    report['pool'] = app.get_pool_stats()
+    snapshot = query_metrics.snapshot()
+    report['queries'] = {'statements': snapshot['statements'], 'slow_queries': snapshot['slow_queries']}
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"Resultados en {args.output}")
+
+
+def compare(app, args):
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.current, encoding='utf-8') as f:
+        current = json.load(f)
+    regressions = 0
+    for section in ('methods', 'views'):
+        for name, result in current.get(section, {}).items():
+            previous = baseline.get(section, {}).get(name)
+            if previous is None or not previous['median_ms']:
+                print(f"{name:<40} {result['median_ms']:>10.2f} ms  (nuevo)")
+                continue
+            ratio = result['median_ms'] / previous['median_ms']
+            flag = ""
+            if ratio > args.threshold:
+                flag = "REGRESIÓN"
+                regressions += 1
+            print(f"{name:<40} {previous['median_ms']:>10.2f} -> {result['median_ms']:>10.2f} ms  x{ratio:.2f} {flag}")
+    print(f"Regresiones: {regressions}")
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks de Evolution Gym sobre datos sintéticos")
+    parser.add_argument("--database", default="evolution_gym_bench",
+                        help="Base de datos de pruebas (no usar la de producción)")
+    parser.add_argument("--seed", type=int, default=42, help="Semilla de los datos y de las consultas")
+    parser.add_argument("--reference-date", type=date.fromisoformat, default=REFERENCE_DATE,
+                        help="Día desde el que se generan las fechas de los datos y los filtros medidos (AAAA-MM-DD)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = subparsers.add_parser("seed", help="Crea la base de pruebas y genera los datos")
+    for name, default in DEFAULT_SIZES.items():
+        seed_parser.add_argument(f"--{name}", type=int, default=default)
+    seed_parser.add_argument("--batch-size", type=int, default=5000, help="Filas por INSERT")
+    seed_parser.add_argument("--reset", action="store_true", help="Vacía las tablas antes de generar")
+    run_parser = subparsers.add_parser("run", help="Mide los métodos de datos y las vistas")
+    run_parser.add_argument("--repeat", type=int, default=5, help="Repeticiones por medición")
+    run_parser.add_argument("--output", default="benchmark.json", help="Archivo JSON de resultados")
+    compare_parser = subparsers.add_parser("compare", help="Compara dos archivos de resultados")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=1.2,
+                                help="Relación de medianas a partir de la cual se marca una regresión")
+
+    args = parser.parse_args(argv)
+    if args.command == "compare":
+        return compare(None, args)
+
+    use_database(args.database)
+    if args.command == "seed":
+        create_database(args.database)
+    commands = {
+        "seed": seed,
+        "run": run,
+    }
+
+    app = common.CommonApp()
+    if not app.connect_to_db():
+        print("No se pudo conectar a la base de datos")
+        return 1
+    try:
+        commands[args.command](app, args)
+    finally:
+        app.close_db_connection()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
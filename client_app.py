@@ -3,28 +3,51 @@ from common import CommonApp
 import os
 from datetime import datetime, timedelta
 import logging
-import bcrypt
+import calendar
+import asyncio
+from dataclasses import dataclass, field
+from passwords import password_hasher, PasswordServiceBusy
+from events import event_bus, event_relay
+from instrumentation import set_route
+from images import ImageTooLarge
 
 # Configuración de logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@dataclass
+class ClientDashboardData:
+    # Un campo por sección del panel; si su consulta falla queda en None y la excepción en errors[nombre]
+    remaining_days: int = None
+    unread_count: int = None
+    notifications: list = None
+    month_attendances: list = None
+    monthly_attendance_counts: list = None
+    errors: dict = field(default_factory=dict)
+
+
 class ClientApp(CommonApp):
     def __init__(self):
         super().__init__()
-        self.payment_images_folder = "payment_images"
         self.selected_file = None
+        self.attendance_page_size = 30
+        self.notification_page_size = 10
 
     async def main(self, page: ft.Page):
         self.page = page
-        self.connect_to_db()
+        await self.aio.connect_to_db()
+        self.start_metrics_server("client")
+        event_relay.start(self)
+        page.on_disconnect = lambda _: self.unsubscribe_events(page)
         page.title = "Evolution Gym - Cliente"
         page.theme_mode = ft.ThemeMode.LIGHT
         page.window_width = 375
         page.window_height = 812
 
         async def route_change(route):
+            set_route(page.route)
             page.views.clear()
+            self.unsubscribe_events(page)
             if page.route == "/":
                 page.views.append(await self.home_view(page))
             elif page.route == "/login":
@@ -70,14 +93,14 @@ class ClientApp(CommonApp):
                 return
 
             try:
-                self.ensure_connection()
-                self.cursor.execute("SELECT * FROM users WHERE username = %s", (username.value,))
-                user = self.cursor.fetchone()
-                if user and bcrypt.checkpw(password.value.encode('utf-8'), user['password'].encode('utf-8')):
+                user = await self.aio.get_user_by_username(username.value)
+                if user and await self.check_credentials(user, password.value, "users"):
                     self.current_user = user
                     await page.go_async("/dashboard")
                 else:
                     page.show_snack_bar(ft.SnackBar(ft.Text("Credenciales incorrectas")))
+            except PasswordServiceBusy:
+                page.show_snack_bar(ft.SnackBar(ft.Text("Servidor ocupado. Por favor, intenta de nuevo en unos segundos.")))
             except Exception as err:
                 logger.error(f"Error en el inicio de sesión: {err}")
                 page.show_snack_bar(ft.SnackBar(ft.Text("Error en el inicio de sesión. Por favor, intenta de nuevo.")))
@@ -113,13 +136,12 @@ class ClientApp(CommonApp):
                 return
 
             try:
-                self.ensure_connection()
-                hashed_password = bcrypt.hashpw(password.value.encode('utf-8'), bcrypt.gensalt())
-                self.cursor.execute("INSERT INTO users (username, password) VALUES (%s, %s)",
-                                    (username.value, hashed_password))
-                self.conn.commit()
+                hashed_password = await password_hasher.hash(password.value)
+                await self.aio.create_user(username.value, hashed_password)
                 page.show_snack_bar(ft.SnackBar(ft.Text("Registro exitoso")))
                 await page.go_async("/login")
+            except PasswordServiceBusy:
+                page.show_snack_bar(ft.SnackBar(ft.Text("Servidor ocupado. Por favor, intenta de nuevo en unos segundos.")))
             except Exception as err:
                 logger.error(f"Error en el registro: {err}")
                 page.show_snack_bar(ft.SnackBar(ft.Text("Error en el registro. Por favor, intenta de nuevo.")))
@@ -144,10 +166,14 @@ class ClientApp(CommonApp):
         if not self.current_user:
             return await self.login_view(page)
 
+        # Las consultas se lanzan en paralelo en segundo plano; la vista se devuelve con marcadores
+        # de carga y cada sección se rellena cuando llega su resultado
+        user_id = self.current_user['id']
+        self.cancel_dashboard_fill(page)
+
         ad_banner = ft.Image(src="superior.png", height=120, fit=ft.ImageFit.FIT_WIDTH)
 
-        days_left = self.get_remaining_days(self.current_user['id'])
-        membership_counter = ft.Text(f"Días restantes de membresía: {days_left}")
+        membership_counter = ft.Text("Días restantes de membresía: …")
 
         gym_name = ft.Text("Evolution Gym", style="headlineMedium", color=ft.colors.BLACK)
         gym_description = ft.Text("Tu centro de entrenamiento de confianza, ofreciendo equipos de última generación y entrenadores profesionales para ayudarte a alcanzar tus metas de fitness.", color=ft.colors.BLACK)
@@ -181,26 +207,132 @@ class ClientApp(CommonApp):
         async def go_to_view_promotions(e):
             await page.go_async("/view_promotions")
 
-        # Obtener las notificaciones pendientes del usuario
-        notifications = self.get_unread_notifications(self.current_user['id'])
-
-        notification_list = ft.Column(scroll=ft.ScrollMode.AUTO)
-        for notification in notifications:
-            notification_item = ft.Column([
+        def show_remaining_days(days_left):
+            membership_counter.value = f"Días restantes de membresía: {days_left}"
+
+        # Notificaciones: contador mantenido en users y lista paginada de las no leídas
+        notification_list = ft.Column([ft.ProgressRing(width=24, height=24)], scroll=ft.ScrollMode.AUTO)
+        notification_items = {}
+        notification_state = {'before': None}
+        unread_badge_text = ft.Text("0", color=ft.colors.WHITE, size=12, weight=ft.FontWeight.BOLD)
+        unread_badge = ft.Container(unread_badge_text, bgcolor=ft.colors.RED, border_radius=10,
+                                    padding=ft.padding.symmetric(horizontal=6, vertical=2), visible=False)
+        more_notifications_button = ft.TextButton("Ver más notificaciones", visible=False)
+        mark_all_button = ft.TextButton("Marcar todas como leídas", visible=False)
+
+        def show_unread_count(count):
+            unread_badge_text.value = str(count)
+            unread_badge.visible = count > 0
+            mark_all_button.visible = count > 0
+
+        def remove_notifications(notification_ids):
+            for notification_id in notification_ids:
+                item = notification_items.pop(notification_id, None)
+                if item is not None:
+                    notification_list.controls.remove(item)
+
+        def create_mark_as_read_handler(notification_id):
+            async def mark_as_read(_):
+                unread_count = await self.aio.mark_notifications_as_read(user_id, [notification_id])
+                if unread_count is not None:
+                    remove_notifications([notification_id])
+                    show_unread_count(unread_count)
+                    await page.update_async()
+            return mark_as_read
+
+        async def mark_all_as_read(_):
+            unread_count = await self.aio.mark_notifications_as_read(user_id)
+            if unread_count is not None:
+                remove_notifications(list(notification_items))
+                more_notifications_button.visible = False
+                notification_state['before'] = None
+                show_unread_count(unread_count)
+                await page.update_async()
+
+        def create_notification_item(notification):
+            sent_at = notification['sent_at']
+            item = ft.Column([
                 ft.Text(notification['message']),
-                ft.Text(notification['sent_at'].strftime("%Y-%m-%d %H:%M:%S")),
-                ft.ElevatedButton("Marcar como leída", on_click=lambda _, n_id=notification['id']: self.mark_notification_as_read(n_id))
-            ])
-            notification_list.controls.append(notification_item)
-
-        # Obtener el historial de asistencias del usuario
-        attendance_history = self.get_attendance_history(self.current_user['id'])
-        attendance_list = ft.Column(scroll=ft.ScrollMode.AUTO)
-        for attendance in attendance_history:
-            attendance_item = ft.Column([
-                ft.Text(attendance['attendance_date'].strftime("%Y-%m-%d"))
+                ft.Text(sent_at if isinstance(sent_at, str) else sent_at.strftime("%Y-%m-%d %H:%M:%S")),
+                ft.ElevatedButton("Marcar como leída", on_click=create_mark_as_read_handler(notification['id']))
             ])
-            attendance_list.controls.append(attendance_item)
+            notification_items[notification['id']] = item
+            return item
+
+        def append_notifications(notifications):
+            notification_list.controls.extend(
+                create_notification_item(notification) for notification in notifications
+                if notification['id'] not in notification_items)
+            if notifications:
+                notification_state['before'] = (notifications[-1]['sent_at'], notifications[-1]['id'])
+            more_notifications_button.visible = len(notifications) == self.notification_page_size
+
+        def show_notifications(notifications):
+            notification_list.controls = []
+            append_notifications(notifications)
+
+        async def load_more_notifications(_):
+            notifications = await self.aio.get_notifications(
+                user_id, limit=self.notification_page_size, before=notification_state['before'])
+            append_notifications(notifications)
+            await page.update_async()
+
+        more_notifications_button.on_click = load_more_notifications
+        mark_all_button.on_click = mark_all_as_read
+
+        # Cambios publicados por el dueño (aprobaciones, notificaciones): solo se actualizan los controles afectados
+        async def on_event(event):
+            payload = event['payload']
+            if event['kind'] == 'notification':
+                if payload['id'] not in notification_items:
+                    notification_list.controls.insert(0, create_notification_item(payload))
+                if 'unread_count' in payload:
+                    show_unread_count(payload['unread_count'])
+            elif event['kind'] == 'notifications_read':
+                remove_notifications(list(notification_items) if payload['ids'] is None else payload['ids'])
+                show_unread_count(payload['unread_count'])
+            elif event['kind'] == 'membership' and 'remaining_days' in payload:
+                show_remaining_days(payload['remaining_days'])
+            elif event['kind'] == 'payment':
+                status_text = "aprobado" if payload['status'] == 'approved' else "rechazado"
+                page.show_snack_bar(ft.SnackBar(ft.Text(f"Tu pago fue {status_text}")))
+            await page.update_async()
+
+        page.session.set("event_unsubscribe", event_bus.subscribe(user_id, on_event))
+
+        # Historial de asistencias: calendario del mes, resumen mensual y detalle bajo demanda
+        attendance_section, attendance_fillers, attendance_failures = self.create_attendance_section(page, user_id)
+        fillers = {
+            'remaining_days': show_remaining_days,
+            'unread_count': show_unread_count,
+            'notifications': show_notifications,
+            **attendance_fillers,
+        }
+
+        def show_remaining_days_error():
+            membership_counter.value = "Días restantes de membresía: no disponible"
+
+        def show_notifications_error():
+            notification_list.controls = [ft.Text("No se pudieron cargar las notificaciones")]
+
+        # Si una consulta falla, solo su sección muestra el error; el resto se sigue rellenando
+        failures = {
+            'remaining_days': show_remaining_days_error,
+            'unread_count': lambda: show_unread_count(0),
+            'notifications': show_notifications_error,
+            **attendance_failures,
+        }
+
+        async def fill_section(name, data):
+            if name in data.errors:
+                logger.error(f"Error al cargar la sección {name} del panel: {data.errors[name]}")
+                failures[name]()
+            else:
+                fillers[name](getattr(data, name))
+            await page.update_async()
+
+        page.session.set("dashboard_fill_task",
+                         asyncio.create_task(self.load_dashboard_data(user_id, on_section=fill_section)))
 
         toggle_sidebar_button = ft.IconButton(
             icon=ft.icons.MENU,
@@ -229,11 +361,16 @@ class ClientApp(CommonApp):
                             ft.ElevatedButton("Subir Comprobante de Pago", on_click=go_to_upload_payment),
                             ft.ElevatedButton("Ver Promociones", on_click=go_to_view_promotions),
                             ft.Divider(),
-                            ft.Text("Notificaciones", style="headlineSmall", weight=ft.FontWeight.BOLD),
+                            ft.Row([
+                                ft.Text("Notificaciones", style="headlineSmall", weight=ft.FontWeight.BOLD),
+                                unread_badge,
+                            ], alignment=ft.MainAxisAlignment.CENTER),
+                            mark_all_button,
                             notification_list,
+                            more_notifications_button,
                             ft.Divider(),
                             ft.Text("Historial de Asistencias", style="headlineSmall", weight=ft.FontWeight.BOLD),
-                            attendance_list,
+                            attendance_section,
                             footer_links
                         ], expand=True, alignment=ft.MainAxisAlignment.CENTER, horizontal_alignment=ft.CrossAxisAlignment.CENTER),
                     ],
@@ -243,7 +380,142 @@ class ClientApp(CommonApp):
         )
 
 
-    
+    def month_range(self, year, month):
+        last_day = calendar.monthrange(year, month)[1]
+        return datetime(year, month, 1).date(), datetime(year, month, last_day).date()
+
+    async def load_dashboard_data(self, user_id, on_section=None):
+        """Consulta en paralelo las secciones del panel y devuelve un ClientDashboardData.
+
+        Si se indica, ``await on_section(nombre, data)`` se llama en cuanto termina cada
+        sección, para poder mostrarla sin esperar a las demás.
+        """
+        today = datetime.now().date()
+        start_date, end_date = self.month_range(today.year, today.month)
+        loads = {
+            'remaining_days': self.aio.get_remaining_days(user_id),
+            'unread_count': self.aio.get_unread_count(user_id),
+            'notifications': self.aio.get_notifications(user_id, limit=self.notification_page_size),
+            'month_attendances': self.aio.get_attendance_history(user_id, start_date=start_date, end_date=end_date),
+            'monthly_attendance_counts': self.aio.get_monthly_attendance_counts(user_id),
+        }
+        names = {asyncio.create_task(load): name for name, load in loads.items()}
+        pending = set(names)
+        data = ClientDashboardData()
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = names[task]
+                    try:
+                        setattr(data, name, task.result())
+                    except Exception as e:
+                        data.errors[name] = e
+                    if on_section is not None:
+                        await on_section(name, data)
+        finally:
+            # Si se cancela (al salir del panel) o falla on_section, no se dejan consultas huérfanas
+            for task in pending:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()  # resultado descartado; evita el aviso de excepción no recuperada
+        return data
+
+    def create_attendance_section(self, page: ft.Page, user_id):
+        """Devuelve la sección de asistencias, las funciones que la rellenan con los datos del panel
+        y las que muestran el error si su consulta falla."""
+        today = datetime.now().date()
+        state = {'year': today.year, 'month': today.month, 'offset': 0}
+
+        month_title = ft.Text(weight=ft.FontWeight.BOLD)
+        calendar_grid = ft.Column(spacing=2)
+        monthly_summary = ft.Column(spacing=2)
+        detail_list = ft.Column()
+        load_more_button = ft.TextButton("Ver historial detallado")
+
+        def show_month(rows):
+            year, month = state['year'], state['month']
+            attended_days = {row['attendance_date'].day for row in rows}
+            month_title.value = f"{year}-{month:02d} · {len(rows)} asistencias"
+            calendar_grid.controls = [ft.Row([
+                ft.Text(day_name, width=32, size=12, text_align=ft.TextAlign.CENTER)
+                for day_name in ["L", "M", "X", "J", "V", "S", "D"]
+            ], spacing=2)]
+            for week in calendar.monthcalendar(year, month):
+                calendar_grid.controls.append(ft.Row([
+                    ft.Container(
+                        ft.Text(str(day) if day else "", size=12, text_align=ft.TextAlign.CENTER),
+                        width=32, height=28, alignment=ft.alignment.center, border_radius=4,
+                        bgcolor=ft.colors.GREEN_200 if day in attended_days else None,
+                    )
+                    for day in week
+                ], spacing=2))
+
+        def show_monthly_summary(rows):
+            monthly_summary.controls = [
+                ft.Text(f"{row['year']}-{row['month']:02d}: {row['total']} asistencias") for row in rows
+            ]
+
+        async def change_month(delta):
+            month = state['month'] + delta
+            state['year'] += (month - 1) // 12
+            state['month'] = (month - 1) % 12 + 1
+            start_date, end_date = self.month_range(state['year'], state['month'])
+            show_month(await self.aio.get_attendance_history(user_id, start_date=start_date, end_date=end_date))
+            await page.update_async()
+
+        async def previous_month(_):
+            await change_month(-1)
+
+        async def next_month(_):
+            await change_month(1)
+
+        async def load_more(_):
+            rows = await self.aio.get_attendance_history(user_id, limit=self.attendance_page_size, offset=state['offset'])
+            state['offset'] += len(rows)
+            detail_list.controls.extend(ft.Text(row['attendance_date'].strftime("%Y-%m-%d")) for row in rows)
+            load_more_button.text = "Cargar más"
+            load_more_button.visible = len(rows) == self.attendance_page_size
+            await page.update_async()
+
+        def show_month_error():
+            calendar_grid.controls = [ft.Text("No se pudieron cargar las asistencias del mes")]
+
+        def show_monthly_summary_error():
+            monthly_summary.controls = [ft.Text("No se pudo cargar el resumen por mes")]
+
+        load_more_button.on_click = load_more
+        month_title.value = f"{state['year']}-{state['month']:02d}"
+        calendar_grid.controls = [ft.ProgressRing(width=24, height=24)]
+
+        section = ft.Column([
+            ft.Row([
+                ft.IconButton(icon=ft.icons.CHEVRON_LEFT, on_click=previous_month),
+                month_title,
+                ft.IconButton(icon=ft.icons.CHEVRON_RIGHT, on_click=next_month),
+            ], alignment=ft.MainAxisAlignment.CENTER),
+            calendar_grid,
+            ft.Text("Resumen por mes", weight=ft.FontWeight.BOLD),
+            monthly_summary,
+            detail_list,
+            load_more_button,
+        ], horizontal_alignment=ft.CrossAxisAlignment.CENTER)
+        return (section,
+                {'month_attendances': show_month, 'monthly_attendance_counts': show_monthly_summary},
+                {'month_attendances': show_month_error, 'monthly_attendance_counts': show_monthly_summary_error})
+
+    def cancel_dashboard_fill(self, page: ft.Page):
+        if page.session.contains_key("dashboard_fill_task"):
+            page.session.get("dashboard_fill_task").cancel()
+            page.session.remove("dashboard_fill_task")
+
+    def unsubscribe_events(self, page: ft.Page):
+        self.cancel_dashboard_fill(page)
+        if page.session.contains_key("event_unsubscribe"):
+            page.session.get("event_unsubscribe")()
+            page.session.remove("event_unsubscribe")
+
     def create_sidebar(self):
         todo_app = TodoApp()
 
@@ -315,10 +587,18 @@ class ClientApp(CommonApp):
                 return
 
             try:
-                destination_path = self.upload_image(self.selected_file, self.payment_images_folder)
-                self.add_payment(self.current_user['id'], float(amount.value), payment_type.value, destination_path)
+                destination_path = await self.aio.upload_image(self.selected_file)
+                if destination_path is None:
+                    raise IOError("No se pudo copiar la imagen")
+                if await self.aio.find_payment_by_image(destination_path):
+                    page.show_snack_bar(ft.SnackBar(ft.Text("Este comprobante ya fue enviado")))
+                    return
+                await self.aio.add_payment(self.current_user['id'], float(amount.value), payment_type.value, destination_path)
                 page.show_snack_bar(ft.SnackBar(ft.Text("Comprobante subido exitosamente")))
                 await page.go_async("/dashboard")
+            except ImageTooLarge as e:
+                page.show_snack_bar(ft.SnackBar(ft.Text(
+                    f"La imagen es demasiado grande (máximo {e.max_bytes // (1024 * 1024)} MB)")))
             except Exception as e:
                 logger.error(f"Error al subir el pago: {e}")
                 page.show_snack_bar(ft.SnackBar(ft.Text("Error al subir el comprobante. Por favor, intenta de nuevo.")))
@@ -346,14 +626,15 @@ class ClientApp(CommonApp):
                     self.page.update()
 
     async def view_promotions(self, page: ft.Page):
-        promotions = self.get_promotions()
+        promotions = await self.aio.get_cached_promotions()
         promotion_list = ft.Column(scroll=ft.ScrollMode.AUTO)
 
         for promotion in promotions:
+            image = promotion['image']
             promotion_item = ft.Column([
                 ft.Text(promotion['title'], size=20, weight=ft.FontWeight.BOLD),
                 ft.Text(promotion['description']),
-                self.show_image(promotion['image_path']),
+                ft.Image(**image) if image else ft.Text(f"Imagen no encontrada: {promotion['image_path']}"),
                 ft.Divider(),
             ])
             promotion_list.controls.append(promotion_item)
@@ -1,10 +1,28 @@
 import flet as ft
 import mysql.connector
+from mysql.connector.constants import ClientFlag
 from datetime import datetime, timedelta
 import base64
 import os
-import bcrypt
 import logging
+import threading
+import asyncio
+import functools
+import contextvars
+import json
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from database import ConnectionPool
+from passwords import password_hasher, PasswordServiceBusy
+from images import thumbnail_cache, asset_server, image_config, image_store, ImageTooLarge
+from promotions import promotions_cache
+from exports import export_to_file, PAYMENT_EXPORT_COLUMNS
+from migrations import REVENUE_ROLLUP_SQL, STATS_ROLLUP_SQL
+import queries
+from queries import EFFECTIVE_REMAINING_DAYS_SQL
+from events import event_bus, make_event, PROCESS_ORIGIN, SCHEDULER_ORIGIN
+from instrumentation import query_metrics, metrics_server, instrumentation_config, current_route, set_route, InstrumentedCursor
 
 # Configuración de logging
 logging.basicConfig(level=logging.INFO)
@@ -15,21 +33,77 @@ db_config = {
     'host': 'localhost',
     'user': 'root',
     'password': '',
-    'database': 'evolution_gym'
+    'database': 'evolution_gym',
+    # rowcount cuenta las filas encontradas, no solo las modificadas
+    'client_flags': [ClientFlag.FOUND_ROWS]
 }
 
+# Tarea programada de vencimientos: días de antelación de los recordatorios
+membership_job_config = {
+    'reminder_days': (7, 3, 1)
+}
+
+# Configuración del pool de conexiones (compartido por todas las sesiones)
+db_pool_config = {
+    'pool_name': 'evolution_gym',
+    'pool_size': 10,
+    'checkout_timeout': 10
+}
+
+_pool_lock = threading.Lock()
+
+# Hilos donde se ejecutan las consultas bloqueantes, fuera del event loop de Flet
+db_executor = ThreadPoolExecutor(max_workers=db_pool_config['pool_size'], thread_name_prefix="db")
+
+# Copias de imágenes: hilos propios para que una subida grande no ocupe los de la base de datos
+file_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="files")
+FILE_METHODS = {'upload_image', 'export_payment_history'}
+
+
+class AsyncQueries:
+    """Versiones awaitables de los métodos de una app.
+
+    ``await app.aio.get_users()`` ejecuta ``app.get_users()`` en ``db_executor``
+    (o en ``file_executor`` si está en FILE_METHODS) para que una consulta
+    lenta no bloquee al resto de sesiones.
+    """
+
+    def __init__(self, app):
+        self._app = app
+
+    def __getattr__(self, name):
+        method = getattr(self._app, name)
+        executor = file_executor if name in FILE_METHODS else db_executor
+
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            # Las métricas atribuyen la consulta a la ruta activa; los clics no pasan por route_change
+            context = contextvars.copy_context()
+            if context.get(current_route) is None and getattr(self._app, 'page', None) is not None:
+                context.run(set_route, self._app.page.route)
+            return await loop.run_in_executor(
+                executor, context.run, functools.partial(method, *args, **kwargs)
+            )
+
+        call.__name__ = name
+        return call
+
+
 class CommonApp:
+    pool = None
+
     def __init__(self):
         self.current_user = None
-        self.conn = None
-        self.cursor = None
+        # Si es True, db_cursor deshace cada transacción en lugar de confirmarla (comprobaciones)
+        self.dry_run = False
+        self.aio = AsyncQueries(self)
 
     def connect_to_db(self):
         try:
-            if self.conn is None or not self.conn.is_connected():
-                self.conn = mysql.connector.connect(**db_config)
-                self.cursor = self.conn.cursor(dictionary=True)
-                logger.info("Conexión a la base de datos establecida con éxito.")
+            with _pool_lock:
+                if CommonApp.pool is None:
+                    CommonApp.pool = ConnectionPool(db_config, **db_pool_config)
+                    logger.info("Pool de conexiones a la base de datos establecido con éxito.")
             return True
         except mysql.connector.Error as err:
             logger.error(f"Error de conexión a la base de datos: {err}")
@@ -39,24 +113,126 @@ class CommonApp:
         if not self.connect_to_db():
             raise Exception("No se pudo establecer la conexión con la base de datos.")
 
+    @contextmanager
+    def db_cursor(self):
+        # Una conexión del pool por operación; commit al salir, rollback si hay error
+        self.ensure_connection()
+        with self.pool.connection() as conn:
+            cursor = InstrumentedCursor(conn.cursor(dictionary=True, buffered=True), query_metrics)
+            try:
+                yield cursor
+                if self.dry_run:
+                    conn.rollback()
+                else:
+                    conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    @contextmanager
+    def db_stream_cursor(self, dictionary=True):
+        # Cursor sin buffer: las filas llegan del servidor a medida que se piden con fetchmany,
+        # así que la memoria no depende del tamaño del resultado. Solo para lecturas.
+        self.ensure_connection()
+        with self.pool.connection() as conn:
+            cursor = InstrumentedCursor(conn.cursor(dictionary=dictionary, buffered=False), query_metrics)
+            try:
+                yield cursor
+            finally:
+                # Si la lectura se interrumpe hay que vaciar el resultado antes de devolver la conexión
+                if conn.unread_result:
+                    conn.consume_results()
+                cursor.close()
+
+    def get_pool_stats(self):
+        if self.pool is None:
+            return {}
+        return self.pool.stats()
+
+    def get_diagnostics(self):
+        diagnostics = query_metrics.snapshot()
+        diagnostics.update({
+            'pool': self.get_pool_stats(),
+            'promotions_cache': promotions_cache.stats(),
+            'thumbnail_cache': thumbnail_cache.stats(),
+            'password_hasher': password_hasher.stats(),
+            'metrics_url': metrics_server.url,
+        })
+        return diagnostics
+
+    def get_metrics_text(self):
+        gauges = {f"gym_db_pool_{name}": value for name, value in self.get_pool_stats().items()
+                  if isinstance(value, (int, float))}
+        promotions = promotions_cache.stats()
+        gauges['gym_promotions_cache_hits'] = promotions['hits']
+        gauges['gym_promotions_cache_misses'] = promotions['misses']
+        thumbnails = thumbnail_cache.stats()
+        gauges['gym_thumbnail_cache_hits'] = thumbnails['hits']
+        gauges['gym_thumbnail_cache_misses'] = thumbnails['misses']
+        gauges['gym_thumbnail_cache_bytes'] = thumbnails['bytes']
+        return query_metrics.prometheus_text(gauges)
+
+    def start_metrics_server(self, app_name):
+        port = instrumentation_config['metrics_ports'].get(app_name)
+        if port is not None:
+            metrics_server.start(self.get_metrics_text, instrumentation_config['metrics_host'], port)
+
     def close_db_connection(self):
-        if self.cursor:
-            self.cursor.close()
-        if self.conn:
-            self.conn.close()
+        with _pool_lock:
+            if CommonApp.pool is not None:
+                CommonApp.pool.close()
+                CommonApp.pool = None
         logger.info("Conexión a la base de datos cerrada.")
 
     def bytes_to_base64(self, bytes_data):
         return base64.b64encode(bytes_data).decode('utf-8')
 
-    def show_image(self, image_path):
+    def image_payload(self, image_path):
+        # Argumentos de ft.Image para la imagen (URL o base64); None si no existe
         try:
+            if image_config['serve_mode'] == 'url':
+                image_url = asset_server.url_for(image_path)
+                if image_url:
+                    return {'src': image_url}
             with open(image_path, "rb") as image_file:
-                image_data = image_file.read()
-                return ft.Image(src_base64=self.bytes_to_base64(image_data))
-        except FileNotFoundError:
+                return {'src_base64': self.bytes_to_base64(image_file.read())}
+        except (FileNotFoundError, TypeError):
             logger.warning(f"Imagen no encontrada: {image_path}")
+            return None
+
+    def show_image(self, image_path):
+        payload = self.image_payload(image_path)
+        if payload is None:
             return ft.Text(f"Imagen no encontrada: {image_path}")
+        return ft.Image(**payload)
+
+    def show_thumbnail(self, image_path, page: ft.Page):
+        # Miniatura ligera; la imagen completa solo se carga al tocarla
+        if image_config['serve_mode'] == 'url':
+            thumbnail_path = thumbnail_cache.get_path(image_path)
+            thumbnail = self.show_image(thumbnail_path) if thumbnail_path else None
+        else:
+            thumbnail = thumbnail_cache.get(image_path)
+            if thumbnail is not None:
+                thumbnail = ft.Image(src_base64=self.bytes_to_base64(thumbnail))
+        if thumbnail is None:
+            return self.show_image(image_path)
+        thumbnail.fit = ft.ImageFit.CONTAIN
+
+        async def close_full_image(_):
+            dlg.open = False
+            await page.update_async()
+
+        async def open_full_image(_):
+            dlg.content = await self.aio.show_image(image_path)
+            page.dialog = dlg
+            dlg.open = True
+            await page.update_async()
+
+        dlg = ft.AlertDialog(actions=[ft.TextButton("Cerrar", on_click=close_full_image)])
+        return ft.GestureDetector(content=thumbnail, on_tap=open_full_image)
 
     async def login_view(self, page: ft.Page):
         username = ft.TextField(label="Nombre de usuario", width=300)
@@ -69,14 +245,14 @@ class CommonApp:
                 return
 
             try:
-                self.ensure_connection()
-                self.cursor.execute("SELECT * FROM users WHERE username = %s", (username.value,))
-                user = self.cursor.fetchone()
-                if user and bcrypt.checkpw(password.value.encode('utf-8'), user['password'].encode('utf-8')):
+                user = await self.aio.get_user_by_username(username.value)
+                if user and await self.check_credentials(user, password.value, "users"):
                     self.current_user = user
                     await page.go_async("/dashboard")
                 else:
                     page.show_snack_bar(ft.SnackBar(ft.Text("Credenciales incorrectas")))
+            except PasswordServiceBusy:
+                page.show_snack_bar(ft.SnackBar(ft.Text("Servidor ocupado. Por favor, intenta de nuevo en unos segundos.")))
             except mysql.connector.Error as err:
                 logger.error(f"Error en el inicio de sesión: {err}")
                 page.show_snack_bar(ft.SnackBar(ft.Text("Error en el inicio de sesión. Por favor, intenta de nuevo.")))
@@ -111,13 +287,12 @@ class CommonApp:
                 return
 
             try:
-                self.ensure_connection()
-                hashed_password = bcrypt.hashpw(password.value.encode('utf-8'), bcrypt.gensalt())
-                self.cursor.execute("INSERT INTO users (username, password) VALUES (%s, %s)",
-                                    (username.value, hashed_password))
-                self.conn.commit()
+                hashed_password = await password_hasher.hash(password.value)
+                await self.aio.create_user(username.value, hashed_password)
                 page.show_snack_bar(ft.SnackBar(ft.Text("Registro exitoso")))
                 await page.go_async("/login")
+            except PasswordServiceBusy:
+                page.show_snack_bar(ft.SnackBar(ft.Text("Servidor ocupado. Por favor, intenta de nuevo en unos segundos.")))
             except mysql.connector.Error as err:
                 logger.error(f"Error en el registro: {err}")
                 page.show_snack_bar(ft.SnackBar(ft.Text("Error en el registro. Por favor, intenta de nuevo.")))
@@ -137,177 +312,414 @@ class CommonApp:
             ],
         )
 
-    def upload_image(self, image_path, destination_folder):
-        if not os.path.exists(destination_folder):
-            os.makedirs(destination_folder)
-        
-        file_name = os.path.basename(image_path)
-        destination_path = os.path.join(destination_folder, file_name)
-        
+    async def check_credentials(self, account, password, table):
+        valid, new_hash = await password_hasher.verify_and_rehash(password, account['password'])
+        if valid and new_hash:
+            await self.aio.update_password_hash(table, account['id'], new_hash)
+        return valid
+
+    def update_password_hash(self, table, account_id, new_hash):
+        if table not in ("users", "owners"):
+            raise ValueError(f"Tabla de cuentas no válida: {table}")
+        try:
+            with self.db_cursor() as cursor:
+                cursor.execute(f"UPDATE {table} SET password = %s WHERE id = %s", (new_hash, account_id))
+            logger.info(f"Hash de contraseña actualizado al coste {password_hasher.rounds}: {table} {account_id}")
+        except mysql.connector.Error as err:
+            logger.error(f"Error al actualizar el hash de contraseña: {err}")
+
+    def upload_image(self, image_path):
+        """Guarda la imagen en el almacén por contenido y devuelve su ruta, o None si falla.
+
+        Lanza ImageTooLarge si supera el tamaño máximo. La imagen queda con cero
+        referencias hasta que un pago o una promoción la usa (``_add_image_reference``).
+        """
+        staged_path = None
         try:
-            with open(image_path, 'rb') as src_file, open(destination_path, 'wb') as dst_file:
-                dst_file.write(src_file.read())
-            logger.info(f"Imagen subida exitosamente: {destination_path}")
+            staged_path, digest, size = image_store.stage(image_path)
+            with self.db_cursor() as cursor:
+                # El bloqueo de la fila evita que prune_image_blobs borre el archivo mientras se coloca
+                cursor.execute("INSERT INTO image_blobs (sha256, path, size, ref_count, created_at) "
+                               "VALUES (%s, %s, %s, 0, NOW()) ON DUPLICATE KEY UPDATE created_at = NOW()",
+                               (digest, image_store.path_for(digest, os.path.splitext(staged_path)[1]), size))
+                # Si el mismo contenido ya se subió con otra extensión se reutiliza su ruta, no se crea otro archivo
+                cursor.execute("SELECT path FROM image_blobs WHERE sha256 = %s", (digest,))
+                destination_path = image_store.commit(staged_path, cursor.fetchone()['path'])
+            logger.info(f"Imagen subida exitosamente: {destination_path} ({size} bytes)")
+            thumbnail_cache.generate(destination_path)
             return destination_path
-        except IOError as e:
+        except ImageTooLarge as e:
+            logger.warning(f"Imagen rechazada: {e}")
+            raise
+        except (IOError, ValueError) as e:
             logger.error(f"Error al subir la imagen: {e}")
             return None
         except Exception as e:
             logger.error(f"Error inesperado al subir la imagen: {e}")
             return None
+        finally:
+            if staged_path is not None and os.path.exists(staged_path):
+                image_store.discard(staged_path)
+
+    def _add_image_reference(self, cursor, image_path):
+        digest = image_store.digest_of(image_path)
+        if digest is not None:
+            cursor.execute("UPDATE image_blobs SET ref_count = ref_count + 1 WHERE sha256 = %s", (digest,))
+
+    def find_payment_by_image(self, image_path):
+        # Mismo contenido = misma ruta en el almacén, así que basta el índice de payments.image_path
+        try:
+            with self.db_cursor() as cursor:
+                cursor.execute(queries.PAYMENT_BY_IMAGE_SQL, (image_path,))
+                return cursor.fetchone()
+        except mysql.connector.Error as err:
+            logger.error(f"Error al buscar comprobantes duplicados: {err}")
+            return None
+
+    def prune_image_blobs(self, max_age_hours=24):
+        """Borra las imágenes del almacén que ningún pago ni promoción usa. Devuelve cuántas se borraron.
+
+        Los archivos se apartan dentro de la transacción (así una subida del mismo
+        contenido tras el commit no encuentra el archivo a medio borrar) y solo se
+        borran después del commit; si la transacción falla vuelven a su sitio.
+        """
+        trashed = []
+        try:
+            with self.db_cursor() as cursor:
+                cursor.execute("SELECT sha256, path FROM image_blobs "
+                               "WHERE ref_count = 0 AND created_at < NOW() - INTERVAL %s HOUR FOR UPDATE", (max_age_hours,))
+                blobs = cursor.fetchall()
+                for blob in blobs:
+                    trashed.append((blob['path'], image_store.trash(blob['path'])))
+                if blobs:
+                    cursor.execute(f"DELETE FROM image_blobs WHERE sha256 IN ({', '.join(['%s'] * len(blobs))})",
+                                   [blob['sha256'] for blob in blobs])
+        except Exception:
+            for path, trash_path in trashed:
+                image_store.restore(trash_path, path)
+            raise
+        for path, trash_path in trashed:
+            if self.dry_run:  # db_cursor deshizo la transacción
+                image_store.restore(trash_path, path)
+            elif trash_path is not None:
+                image_store.remove(trash_path)
+        logger.info(f"Imágenes sin referencias borradas: {len(blobs)}")
+        return len(blobs)
 
     def get_remaining_days(self, user_id):
         try:
-            self.ensure_connection()
-            self.cursor.execute("SELECT remaining_days, membership_end_date FROM users WHERE id = %s", (user_id,))
-            result = self.cursor.fetchone()
-            if result:
-                remaining_days = result['remaining_days']
-                end_date = result['membership_end_date']
-                if end_date:
-                    days_until_end = (end_date - datetime.now().date()).days
-                    return min(remaining_days, max(0, days_until_end))
-                return remaining_days
-            return 0
+            with self.db_cursor() as cursor:
+                cursor.execute(queries.REMAINING_DAYS_SQL, (user_id,))
+                result = cursor.fetchone()
+            return result['remaining_days'] if result else 0
         except mysql.connector.Error as err:
             logger.error(f"Error al obtener los días restantes: {err}")
             return 0
 
+    def _subtract_remaining_days(self, cursor, user_id, days_to_subtract):
+        # Descuento atómico en el servidor. LAST_INSERT_ID(expr) devuelve el nuevo saldo
+        # en la respuesta del propio UPDATE (cursor.lastrowid), sin un SELECT adicional.
+        cursor.execute(f"""
+            UPDATE users
+            SET remaining_days = LAST_INSERT_ID(GREATEST({EFFECTIVE_REMAINING_DAYS_SQL} - %s, 0))
+            WHERE id = %s
+        """, (days_to_subtract, user_id))
+        if cursor.rowcount == 0:
+            return None
+        return cursor.lastrowid or 0
+
     def update_remaining_days(self, user_id, days_to_subtract=1):
         try:
-            self.ensure_connection()
-            remaining_days = self.get_remaining_days(user_id)
-            new_remaining_days = max(0, remaining_days - days_to_subtract)
-            self.cursor.execute("UPDATE users SET remaining_days = %s WHERE id = %s", (new_remaining_days, user_id))
-            self.conn.commit()
+            with self.db_cursor() as cursor:
+                new_remaining_days = self._subtract_remaining_days(cursor, user_id, days_to_subtract)
             logger.info(f"Días restantes actualizados para el usuario {user_id}: {new_remaining_days}")
+            return new_remaining_days
         except mysql.connector.Error as err:
             logger.error(f"Error al actualizar los días restantes: {err}")
-            self.conn.rollback()
+            return None
 
     def record_attendance(self, user_id):
+        """Registra la asistencia y descuenta un día en una sola transacción. Devuelve el nuevo saldo o None."""
         try:
-            self.ensure_connection()
-            today = datetime.now().date()
-            self.cursor.execute("INSERT INTO attendances (user_id, attendance_date) VALUES (%s, %s)", (user_id, today))
-            self.conn.commit()
-            self.update_remaining_days(user_id)
-            logger.info(f"Asistencia registrada para el usuario {user_id}")
+            now = datetime.now()
+            today = now.date()
+            with self.db_cursor() as cursor:
+                # El UPDATE bloquea la fila del usuario: dos check-ins simultáneos se serializan
+                new_remaining_days = self._subtract_remaining_days(cursor, user_id, 1)
+                if new_remaining_days is None:
+                    logger.warning(f"Asistencia no registrada: usuario {user_id} no encontrado")
+                    return None
+                cursor.execute("INSERT INTO attendances (user_id, attendance_date, attended_at) VALUES (%s, %s, %s)",
+                               (user_id, today, now.replace(microsecond=0)))
+                self._bump_daily_attendance(cursor, today, 1)
+                event = self._record_event(cursor, user_id, 'membership', {'remaining_days': new_remaining_days})
+            event_bus.publish(event)
+            logger.info(f"Asistencia registrada para el usuario {user_id}. Días restantes: {new_remaining_days}")
+            return new_remaining_days
         except mysql.connector.Error as err:
             logger.error(f"Error al registrar la asistencia: {err}")
-            self.conn.rollback()
+            return None
+
+    def record_attendance_bulk(self, entries):
+        """Registra un lote de asistencias [(user_id, fecha_hora), ...] en una sola transacción.
+
+        Devuelve un resultado por entrada con ``status`` 'recorded', 'unknown_user',
+        'invalid' o 'error' y el saldo final de días del usuario.
+        """
+        results = []
+        accepted = []
+        for user_id, timestamp in entries:
+            result = {'user_id': user_id, 'timestamp': timestamp, 'status': 'invalid', 'remaining_days': None}
+            try:
+                user_id = int(user_id)
+                day = timestamp.date() if isinstance(timestamp, datetime) else timestamp
+                accepted.append((result, user_id, day))
+            except (TypeError, ValueError, AttributeError):
+                pass
+            results.append(result)
+        if not accepted:
+            return results
+
+        user_ids = sorted({user_id for _, user_id, _ in accepted})
+        id_placeholders = ", ".join(["%s"] * len(user_ids))
+        try:
+            with self.db_cursor() as cursor:
+                # Bloqueo en orden de id para no provocar interbloqueos con otros check-ins
+                cursor.execute(f"SELECT id FROM users WHERE id IN ({id_placeholders}) ORDER BY id FOR UPDATE", user_ids)
+                known_ids = {row['id'] for row in cursor.fetchall()}
+                recorded = [(result, user_id, day) for result, user_id, day in accepted if user_id in known_ids]
+
+                if recorded:
+                    cursor.executemany("INSERT INTO attendances (user_id, attendance_date, attended_at) VALUES (%s, %s, %s)",
+                                       [(user_id, day, result['timestamp'] if isinstance(result['timestamp'], datetime) else None)
+                                        for result, user_id, day in recorded])
+
+                    visits = Counter(user_id for _, user_id, _ in recorded)
+                    visits_table = " UNION ALL ".join(["SELECT %s AS user_id, %s AS visits"] * len(visits))
+                    cursor.execute(f"""
+                        UPDATE users
+                        JOIN ({visits_table}) AS batch ON users.id = batch.user_id
+                        SET remaining_days = GREATEST({EFFECTIVE_REMAINING_DAYS_SQL} - batch.visits, 0)
+                    """, [value for item in visits.items() for value in item])
+
+                    for day, total in Counter(day for _, _, day in recorded).items():
+                        self._bump_daily_attendance(cursor, day, total)
+
+                    cursor.execute(f"SELECT id, remaining_days FROM users WHERE id IN ({id_placeholders})", user_ids)
+                    balances = {row['id']: row['remaining_days'] for row in cursor.fetchall()}
+                    events = [self._record_event(cursor, user_id, 'membership', {'remaining_days': balances[user_id]})
+                              for user_id in visits]
+            if recorded:
+                event_bus.publish_all(events)
+
+            for result, user_id, _ in accepted:
+                if user_id in known_ids:
+                    result['status'] = 'recorded'
+                    result['remaining_days'] = balances[user_id]
+                else:
+                    result['status'] = 'unknown_user'
+            logger.info(f"Lote de asistencias registrado: {len(recorded)} de {len(results)} entradas")
+        except mysql.connector.Error as err:
+            logger.error(f"Error al registrar el lote de asistencias: {err}")
+            for result, _, _ in accepted:
+                result['status'] = 'error'
+        return results
 
     def get_promotions(self):
         try:
-            self.ensure_connection()
-            self.cursor.execute("SELECT * FROM promotions ORDER BY created_at DESC")
-            return self.cursor.fetchall()
+            with self.db_cursor() as cursor:
+                cursor.execute(queries.PROMOTIONS_SQL)
+                return cursor.fetchall()
+        except mysql.connector.Error as err:
+            logger.error(f"Error al obtener las promociones: {err}")
+            return []
+
+    def _load_promotions(self):
+        # Sin capturar errores: un fallo de la base de datos no debe quedar en caché como lista vacía
+        with self.db_cursor() as cursor:
+            cursor.execute(queries.CACHED_PROMOTIONS_SQL)
+            promotions = cursor.fetchall()
+        return [{**promotion, 'image': self.image_payload(promotion['image_path'])} for promotion in promotions]
+
+    def get_cached_promotions(self):
+        """Promociones con el payload de su imagen ('image'), desde la caché del proceso."""
+        try:
+            return promotions_cache.get(self._load_promotions)
         except mysql.connector.Error as err:
             logger.error(f"Error al obtener las promociones: {err}")
             return []
 
     def add_promotion(self, title, description, image_path):
         try:
-            self.ensure_connection()
-            self.cursor.execute("INSERT INTO promotions (title, description, image_path) VALUES (%s, %s, %s)",
-                                (title, description, image_path))
-            self.conn.commit()
+            with self.db_cursor() as cursor:
+                cursor.execute("INSERT INTO promotions (title, description, image_path) VALUES (%s, %s, %s)",
+                               (title, description, image_path))
+                self._add_image_reference(cursor, image_path)
+            promotions_cache.invalidate()
             logger.info(f"Nueva promoción añadida: {title}")
             return True
         except mysql.connector.Error as err:
             logger.error(f"Error al añadir la promoción: {err}")
-            self.conn.rollback()
             return False
 
     def get_pending_payments(self):
         try:
-            self.ensure_connection()
-            self.cursor.execute("SELECT * FROM payments WHERE status = 'pending' ORDER BY payment_date DESC")
-            return self.cursor.fetchall()
+            with self.db_cursor() as cursor:
+                cursor.execute("SELECT * FROM payments WHERE status = 'pending' ORDER BY payment_date DESC")
+                return cursor.fetchall()
         except mysql.connector.Error as err:
             logger.error(f"Error al obtener pagos pendientes: {err}")
             return []
         
     def update_payment_status(self, payment_id, new_status):
         try:
-            self.ensure_connection()
-            self.cursor.execute("UPDATE payments SET status = %s WHERE id = %s", (new_status, payment_id))
-            self.conn.commit()
+            with self.db_cursor() as cursor:
+                cursor.execute("SELECT user_id, amount, payment_date, payment_type, status FROM payments WHERE id = %s FOR UPDATE",
+                               (payment_id,))
+                previous = cursor.fetchone()
+                cursor.execute("UPDATE payments SET status = %s WHERE id = %s", (new_status, payment_id))
+                event = None
+                if previous and previous['status'] != new_status:
+                    if new_status == 'approved':
+                        self._bump_counter(cursor, 'total_income', previous['amount'])
+                    elif previous['status'] == 'approved':
+                        self._bump_counter(cursor, 'total_income', -previous['amount'])
+                    self._bump_revenue(cursor, [previous], previous['status'], new_status)
+                    event = self._record_event(cursor, previous['user_id'], 'payment',
+                                               {'payment_id': payment_id, 'status': new_status})
+            if event:
+                event_bus.publish(event)
             logger.info(f"Estado de pago actualizado: ID {payment_id}, Nuevo estado: {new_status}")
             return True
         except mysql.connector.Error as err:
             logger.error(f"Error al actualizar el estado del pago: {err}")
-            self.conn.rollback()
             return False
 
-    from decimal import Decimal
+    def review_payments(self, payment_ids, new_status):
+        """Aprueba o rechaza un lote de pagos pendientes en una sola transacción.
 
-    def update_membership(self, user_id, membership_type, payment_amount):
+        Al aprobar, renueva las membresías (el monto son los días, como en
+        ``update_membership``) y crea las notificaciones con sentencias sobre el
+        conjunto. Devuelve los ids de los pagos que seguían pendientes, o None si hubo un error.
+        """
+        payment_ids = [int(payment_id) for payment_id in payment_ids]
+        if not payment_ids:
+            return []
+        placeholders = ', '.join(['%s'] * len(payment_ids))
+        today = datetime.now().date()
+        sent_at = datetime.now().replace(microsecond=0)
         try:
-            self.ensure_connection()
-            start_date = datetime.now().date()
-            
-            # Determinar la duración basada en el tipo de membresía
-            if membership_type == "normal":
-                duration_days = 15
-            elif membership_type == "full":
-                duration_days = 30
-            else:
-                raise ValueError("Tipo de membresía no válido")
-            
-            # Asegurarse de que duration_days sea un entero
-            duration_days = int(duration_days)
-            
-            # Convertir user_id a entero si es necesario
-            user_id = int(user_id)
-            
-            end_date = start_date + timedelta(days=duration_days)
-            
-            self.cursor.execute("""
-                UPDATE users 
-                SET membership_type = %s, 
-                    membership_start_date = %s, 
-                    membership_end_date = %s, 
-                    remaining_days = %s 
-                WHERE id = %s
-            """, (membership_type, start_date, end_date, duration_days, user_id))
-            
-            self.conn.commit()
-            
-            # Crear una notificación de expiración de membresía
-            expiration_date = end_date.strftime("%Y-%m-%d")
-            notification_message = f"Tu membresía {membership_type} expira el {expiration_date}"
-            self.create_notification(user_id, notification_message, datetime.now())
-            
-            logger.info(f"Membresía actualizada: Usuario {user_id}, Tipo {membership_type}, Duración {duration_days} días")
-            return True
-        except Exception as e:
-            logger.error(f"Error al actualizar la membresía: {e}")
-            self.conn.rollback()
-            return False
+            with self.db_cursor() as cursor:
+                cursor.execute(f"SELECT id, user_id, amount, payment_date, payment_type FROM payments "
+                               f"WHERE id IN ({placeholders}) AND status = 'pending' ORDER BY id FOR UPDATE", payment_ids)
+                payments = cursor.fetchall()
+                if not payments:
+                    return []
+                reviewed_ids = [payment['id'] for payment in payments]
+                reviewed_placeholders = ', '.join(['%s'] * len(reviewed_ids))
+                cursor.execute(f"UPDATE payments SET status = %s WHERE id IN ({reviewed_placeholders})",
+                               [new_status] + reviewed_ids)
+                self._bump_revenue(cursor, payments, 'pending', new_status)
+                events = [make_event(payment['user_id'], 'payment', {'payment_id': payment['id'], 'status': new_status})
+                          for payment in payments]
 
+                if new_status == 'approved':
+                    self._bump_counter(cursor, 'total_income', sum(payment['amount'] for payment in payments))
+                    # Si un usuario tiene varios pagos en el lote, vale el último (como al aprobarlos uno a uno)
+                    latest = {payment['user_id']: payment for payment in payments}
+                    user_ids = sorted(latest)
+                    user_placeholders = ', '.join(['%s'] * len(user_ids))
+                    latest_placeholders = ', '.join(['%s'] * len(latest))
+                    cursor.execute(f"SELECT id, membership_end_date FROM users WHERE id IN ({user_placeholders}) FOR UPDATE",
+                                   user_ids)
+                    users = cursor.fetchall()
+                    new_end_dates = {user['id']: today + timedelta(days=int(latest[user['id']]['amount'])) for user in users}
+                    expiry_deltas = Counter()
+                    for user in users:
+                        if user['membership_end_date']:
+                            expiry_deltas[user['membership_end_date']] -= 1
+                        expiry_deltas[new_end_dates[user['id']]] += 1
+
+                    cursor.execute(f"""
+                        UPDATE users u JOIN payments p ON p.user_id = u.id
+                        SET u.membership_type = p.payment_type,
+                            u.membership_start_date = %s,
+                            u.membership_end_date = DATE_ADD(%s, INTERVAL FLOOR(p.amount) DAY),
+                            u.remaining_days = FLOOR(p.amount),
+                            u.unread_notifications = u.unread_notifications + 1
+                        WHERE p.id IN ({latest_placeholders})
+                    """, [today, today] + [payment['id'] for payment in latest.values()])
+                    cursor.executemany("INSERT INTO stats_membership_expiry (end_date, total) VALUES (%s, %s) "
+                                       "ON DUPLICATE KEY UPDATE total = total + VALUES(total)",
+                                       [(end_date, delta) for end_date, delta in sorted(expiry_deltas.items()) if delta])
+                    # Un único INSERT de varias filas recibe ids consecutivos (ver run_membership_maintenance):
+                    # las notificaciones de este lote son exactamente first_id..last_id
+                    rows = []
+                    if users:
+                        cursor.executemany("INSERT INTO notifications (user_id, message, sent_at) VALUES (%s, %s, %s)",
+                                           [(user_id, f"Tu membresía expira el {end_date}", sent_at)
+                                            for user_id, end_date in new_end_dates.items()])
+                        first_id = cursor.lastrowid
+                        last_id = first_id + len(users) - 1
+                        cursor.execute("""
+                            SELECT n.id, n.user_id, n.message, n.sent_at, u.membership_type, u.membership_end_date,
+                                   u.remaining_days, u.unread_notifications
+                            FROM notifications n
+                            JOIN users u ON u.id = n.user_id
+                            WHERE n.id BETWEEN %s AND %s
+                        """, (first_id, last_id))
+                        rows = cursor.fetchall()
+                    for row in rows:
+                        events.append(make_event(row['user_id'], 'membership', {
+                            'membership_type': row['membership_type'],
+                            'membership_end_date': row['membership_end_date'],
+                            'remaining_days': row['remaining_days'],
+                        }))
+                        events.append(make_event(row['user_id'], 'notification', {
+                            'id': row['id'], 'message': row['message'], 'sent_at': row['sent_at'],
+                            'unread_count': row['unread_notifications'],
+                        }))
+
+                self._record_events(cursor, events)
+            event_bus.publish_all(events)
+            logger.info(f"Pagos {new_status}: {len(reviewed_ids)} de {len(payment_ids)} seleccionados")
+            return reviewed_ids
+        except mysql.connector.Error as err:
+            logger.error(f"Error al actualizar el lote de pagos: {err}")
+            return None
 
     def add_payment(self, user_id, amount, payment_type, image_path):
         try:
-            self.ensure_connection()
-            self.cursor.execute("INSERT INTO payments (user_id, amount, payment_date, payment_type, image_path, status) VALUES (%s, %s, %s, %s, %s, 'pending')",
-                                (user_id, amount, datetime.now().date(), payment_type, image_path))
-            self.conn.commit()
+            payment_date = datetime.now().date()
+            with self.db_cursor() as cursor:
+                cursor.execute("INSERT INTO payments (user_id, amount, payment_date, payment_type, image_path, status) VALUES (%s, %s, %s, %s, %s, 'pending')",
+                               (user_id, amount, payment_date, payment_type, image_path))
+                self._add_image_reference(cursor, image_path)
+                self._bump_revenue(cursor, [{'amount': amount, 'payment_date': payment_date, 'payment_type': payment_type}],
+                                   None, 'pending')
             logger.info(f"Nuevo pago añadido: Usuario {user_id}, Monto {amount}, Tipo {payment_type}")
             return True
         except mysql.connector.Error as err:
             logger.error(f"Error al añadir el pago: {err}")
-            self.conn.rollback()
             return False
 
     def update_membership(self, user_id, membership_type, duration_days):
         try:
-            self.ensure_connection()
             start_date = datetime.now().date()
             end_date = start_date + timedelta(days=duration_days)
-            self.cursor.execute("UPDATE users SET membership_type = %s, membership_start_date = %s, membership_end_date = %s, remaining_days = %s WHERE id = %s",
-                            (membership_type, start_date, end_date, duration_days, user_id))
-            self.conn.commit()
+            with self.db_cursor() as cursor:
+                cursor.execute("SELECT membership_end_date FROM users WHERE id = %s FOR UPDATE", (user_id,))
+                previous = cursor.fetchone()
+                cursor.execute("UPDATE users SET membership_type = %s, membership_start_date = %s, membership_end_date = %s, remaining_days = %s WHERE id = %s",
+                               (membership_type, start_date, end_date, duration_days, user_id))
+                if previous:
+                    self._move_membership_expiry(cursor, previous['membership_end_date'], end_date)
+                event = self._record_event(cursor, user_id, 'membership', {
+                    'membership_type': membership_type,
+                    'membership_end_date': end_date,
+                    'remaining_days': duration_days,
+                })
+            event_bus.publish(event)
             
             # Crear una notificación de expiración de membresía
             expiration_date = end_date.strftime("%Y-%m-%d")
@@ -318,70 +730,331 @@ class CommonApp:
             return True
         except mysql.connector.Error as err:
             logger.error(f"Error al actualizar la membresía: {err}")
-            self.conn.rollback()
             return False
 
     def create_notification(self, user_id, message, sent_at):
-            try:
-                self.ensure_connection()
-                self.cursor.execute("INSERT INTO notifications (user_id, message, sent_at) VALUES (%s, %s, %s)", (user_id, message, sent_at))
-                self.conn.commit()
-                logger.info(f"Nueva notificación creada para el usuario {user_id}: {message}")
-            except mysql.connector.Error as err:
-                logger.error(f"Error al crear la notificación: {err}")
-                self.conn.rollback()
+        try:
+            with self.db_cursor() as cursor:
+                cursor.execute("INSERT INTO notifications (user_id, message, sent_at) VALUES (%s, %s, %s)", (user_id, message, sent_at))
+                notification_id = cursor.lastrowid
+                cursor.execute("UPDATE users SET unread_notifications = LAST_INSERT_ID(unread_notifications + 1) WHERE id = %s",
+                               (user_id,))
+                event = self._record_event(cursor, user_id, 'notification',
+                                           {'id': notification_id, 'message': message, 'sent_at': sent_at,
+                                            'unread_count': cursor.lastrowid})
+            event_bus.publish(event)
+            logger.info(f"Nueva notificación creada para el usuario {user_id}: {message}")
+        except mysql.connector.Error as err:
+            logger.error(f"Error al crear la notificación: {err}")
 
     def get_unread_notifications(self, user_id):
         try:
-            self.ensure_connection()
-            self.cursor.execute("SELECT * FROM notifications WHERE user_id = %s AND is_read = 0 ORDER BY sent_at DESC", (user_id,))
-            return self.cursor.fetchall()
+            with self.db_cursor() as cursor:
+                cursor.execute("SELECT * FROM notifications WHERE user_id = %s AND is_read = 0 ORDER BY sent_at DESC", (user_id,))
+                return cursor.fetchall()
+        except mysql.connector.Error as err:
+            logger.error(f"Error al obtener notificaciones: {err}")
+            return []
+
+    def get_notifications(self, user_id, limit=10, before=None):
+        # Página de notificaciones sin leer, de la más reciente a la más antigua.
+        # before=(sent_at, id) de la última fila de la página anterior
+        query, params = queries.notifications_query(user_id, limit, before)
+        try:
+            with self.db_cursor() as cursor:
+                cursor.execute(query, params)
+                return cursor.fetchall()
         except mysql.connector.Error as err:
             logger.error(f"Error al obtener notificaciones: {err}")
             return []
 
+    def get_unread_count(self, user_id):
+        try:
+            with self.db_cursor() as cursor:
+                cursor.execute(queries.UNREAD_COUNT_SQL, (user_id,))
+                result = cursor.fetchone()
+                return result['unread_notifications'] if result else 0
+        except mysql.connector.Error as err:
+            logger.error(f"Error al obtener el contador de notificaciones: {err}")
+            return 0
+
+    def mark_notifications_as_read(self, user_id, notification_ids=None):
+        """Marca como leídas las notificaciones indicadas (o todas si ``notification_ids`` es None) con una sola sentencia.
+
+        Devuelve el nuevo número de notificaciones sin leer, o None si hubo un error.
+        """
+        query = "UPDATE notifications SET is_read = 1 WHERE user_id = %s AND is_read = 0"
+        params = [user_id]
+        if notification_ids is not None:
+            notification_ids = [int(notification_id) for notification_id in notification_ids]
+            if not notification_ids:
+                return self.get_unread_count(user_id)
+            query += f" AND id IN ({', '.join(['%s'] * len(notification_ids))})"
+            params += notification_ids
+        try:
+            with self.db_cursor() as cursor:
+                cursor.execute(query, params)
+                changed = cursor.rowcount
+                cursor.execute("UPDATE users SET unread_notifications = LAST_INSERT_ID(GREATEST(unread_notifications - %s, 0)) "
+                               "WHERE id = %s", (changed, user_id))
+                unread_count = cursor.lastrowid or 0
+                event = self._record_event(cursor, user_id, 'notifications_read',
+                                           {'ids': notification_ids, 'unread_count': unread_count})
+            event_bus.publish(event)
+            logger.info(f"{changed} notificaciones del usuario {user_id} marcadas como leídas")
+            return unread_count
+        except mysql.connector.Error as err:
+            logger.error(f"Error al marcar las notificaciones como leídas: {err}")
+            return None
+
     def mark_notification_as_read(self, notification_id):
         try:
-            self.ensure_connection()
-            self.cursor.execute("UPDATE notifications SET is_read = 1 WHERE id = %s", (notification_id,))
-            self.conn.commit()
-            logger.info(f"Notificación {notification_id} marcada como leída")
+            with self.db_cursor() as cursor:
+                cursor.execute("SELECT user_id FROM notifications WHERE id = %s", (notification_id,))
+                result = cursor.fetchone()
         except mysql.connector.Error as err:
             logger.error(f"Error al marcar la notificación como leída: {err}")
-            self.conn.rollback()
+            return None
+        if not result:
+            return None
+        return self.mark_notifications_as_read(result['user_id'], [notification_id])
     
-    def get_attendance_history(self, user_id):
+    def get_attendance_history(self, user_id, limit=None, offset=0, start_date=None, end_date=None):
+        query, params = queries.attendance_history_query(user_id, limit, offset, start_date, end_date)
         try:
-            self.ensure_connection()
-            self.cursor.execute("SELECT * FROM attendances WHERE user_id = %s ORDER BY attendance_date DESC", (user_id,))
-            return self.cursor.fetchall()
+            with self.db_cursor() as cursor:
+                cursor.execute(query, params)
+                return cursor.fetchall()
         except mysql.connector.Error as err:
             logger.error(f"Error al obtener el historial de asistencias: {err}")
             return []
-        
-    def get_unread_notifications(self, user_id):
+
+    def get_monthly_attendance_counts(self, user_id, months=12):
+        # Agregado en el servidor: una fila por mes en lugar de una por asistencia
+        first_day = datetime.now().date().replace(day=1)
+        for _ in range(months - 1):
+            first_day = (first_day - timedelta(days=1)).replace(day=1)
         try:
-            self.ensure_connection()
-            self.cursor.execute("SELECT * FROM notifications WHERE user_id = %s AND is_read = 0 ORDER BY sent_at DESC", (user_id,))
-            return self.cursor.fetchall()
+            with self.db_cursor() as cursor:
+                cursor.execute(queries.MONTHLY_ATTENDANCE_COUNTS_SQL, (user_id, first_day))
+                return cursor.fetchall()
         except mysql.connector.Error as err:
-            logger.error(f"Error al obtener notificaciones: {err}")
+            logger.error(f"Error al obtener el resumen mensual de asistencias: {err}")
             return []
 
-    def mark_notification_as_read(self, notification_id):
-        try:
-            self.ensure_connection()
-            self.cursor.execute("UPDATE notifications SET is_read = 1 WHERE id = %s", (notification_id,))
-            self.conn.commit()
-            logger.info(f"Notificación {notification_id} marcada como leída")
-        except mysql.connector.Error as err:
-            logger.error(f"Error al marcar la notificación como leída: {err}")
-            self.conn.rollback()
+    def get_user_by_username(self, username):
+        with self.db_cursor() as cursor:
+            cursor.execute(queries.USER_BY_USERNAME_SQL, (username,))
+            return cursor.fetchone()
+
+    def create_user(self, username, hashed_password):
+        with self.db_cursor() as cursor:
+            cursor.execute("INSERT INTO users (username, password) VALUES (%s, %s)",
+                           (username, hashed_password))
+            self._bump_counter(cursor, 'total_users', 1)
+        logger.info(f"Nuevo usuario registrado: {username}")
+
     def get_user_by_id(self, user_id):
         try:
-            self.ensure_connection()
-            self.cursor.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-            return self.cursor.fetchone()
+            with self.db_cursor() as cursor:
+                cursor.execute("SELECT * FROM users WHERE id = %s", (user_id,))
+                return cursor.fetchone()
         except mysql.connector.Error as err:
             logger.error(f"Error al obtener usuario por ID: {err}")
-            return None
\ No newline at end of file
+            return None
+
+    def run_membership_maintenance(self, reminder_days=None, today=None):
+        """Vence las membresías y envía los recordatorios de vencimiento con sentencias sobre conjuntos.
+
+        Pensada para ejecutarse a diario (``maintenance.py expire-memberships`` desde cron).
+        Solo notifica los vencimientos ocurridos desde la última ejecución, así que
+        repetirla el mismo día no duplica notificaciones y un día perdido se recupera.
+        """
+        reminder_days = membership_job_config['reminder_days'] if reminder_days is None else reminder_days
+        today = today or datetime.now().date()
+        sent_at = datetime.now().replace(microsecond=0)
+        with self.db_cursor() as cursor:
+            cursor.execute("INSERT IGNORE INTO scheduled_jobs (name) VALUES ('membership_maintenance')")
+            cursor.execute("SELECT last_run FROM scheduled_jobs WHERE name = 'membership_maintenance' FOR UPDATE")
+            last_run = cursor.fetchone()['last_run']
+            since = last_run if last_run is not None else today - timedelta(days=1)
+
+            # Membresías vencidas desde la última ejecución o que vencen dentro de N días
+            cursor.execute(*queries.membership_reminders_query(today, since, reminder_days))
+            reminders = cursor.fetchall()
+            notified = len(reminders)
+            if reminders:
+                # executemany envía un único INSERT de varias filas: InnoDB le asigna ids consecutivos,
+                # así que las notificaciones de esta ejecución son exactamente first_id..last_id
+                cursor.executemany("INSERT INTO notifications (user_id, message, sent_at) VALUES (%s, %s, %s)",
+                                   [(row['id'], row['message'], sent_at) for row in reminders])
+                first_id = cursor.lastrowid
+                last_id = first_id + notified - 1
+                cursor.execute("""
+                    UPDATE users u
+                    JOIN notifications n ON n.user_id = u.id AND n.id BETWEEN %s AND %s
+                    SET u.unread_notifications = u.unread_notifications + 1
+                """, (first_id, last_id))
+                cursor.execute("""
+                    INSERT INTO app_events (origin, user_id, kind, payload)
+                    SELECT %s, n.user_id, 'notification',
+                           JSON_OBJECT('id', n.id, 'message', n.message, 'sent_at', %s,
+                                       'unread_count', u.unread_notifications)
+                    FROM notifications n
+                    JOIN users u ON u.id = n.user_id
+                    WHERE n.id BETWEEN %s AND %s
+                """, (SCHEDULER_ORIGIN, str(sent_at), first_id, last_id))
+
+            # Saldo a cero para todas las membresías vencidas
+            cursor.execute(f"""
+                INSERT INTO app_events (origin, user_id, kind, payload)
+                SELECT %s, id, 'membership', JSON_OBJECT('remaining_days', 0)
+                FROM users WHERE {queries.EXPIRED_MEMBERSHIPS_CONDITION}
+            """, (SCHEDULER_ORIGIN, today))
+            cursor.execute(queries.EXPIRE_MEMBERSHIPS_SQL, (today,))
+            expired = cursor.rowcount
+
+            cursor.execute("UPDATE scheduled_jobs SET last_run = %s, finished_at = NOW() "
+                           "WHERE name = 'membership_maintenance'", (today,))
+        logger.info(f"Vencimientos: {expired} membresías vencidas, {notified} notificaciones enviadas")
+        return {'expired': expired, 'notified': notified}
+
+    def iter_payment_history(self, chunk_size=1000, filters=None):
+        """Recorre los pagos en orden de id, leyendo del servidor de ``chunk_size`` en ``chunk_size``."""
+        conditions, params = queries.payment_history_conditions(filters)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self.db_stream_cursor() as cursor:
+            cursor.execute(f"""
+                SELECT p.id, p.user_id, u.username, p.amount, p.payment_date, p.payment_type, p.status
+                FROM payments p
+                JOIN users u ON p.user_id = u.id
+                {where}
+                ORDER BY p.id
+            """, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+
+    def export_payment_history(self, path, fmt='csv', chunk_size=1000, filters=None):
+        """Exporta el historial de pagos a CSV o JSONL con memoria constante. Devuelve el número de pagos."""
+        return export_to_file(self.iter_payment_history(chunk_size, filters), path, fmt, PAYMENT_EXPORT_COLUMNS)
+
+    def iter_attendance_chunks(self, after_id=0, chunk_size=50000, missing_ids=()):
+        """Asistencias con id > ``after_id`` (o en ``missing_ids``) en bloques de tuplas numéricas
+        (id, user_id, día, franja).
+
+        El día es TO_DAYS(attendance_date) y la franja WEEKDAY * 24 + HOUR de
+        attended_at, o -1 si la asistencia no tiene hora (registros anteriores a la migración 10).
+        """
+        with self.db_stream_cursor(dictionary=False) as cursor:
+            cursor.execute(*queries.attendance_chunks_query(after_id, missing_ids))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+
+    def _record_event(self, cursor, user_id, kind, payload):
+        # Se guarda en la misma transacción para los otros procesos (EventRelay);
+        # el llamador lo publica en este proceso después del commit
+        event = make_event(user_id, kind, payload)
+        cursor.execute("INSERT INTO app_events (origin, user_id, kind, payload) VALUES (%s, %s, %s, %s)",
+                       (PROCESS_ORIGIN, user_id, kind, json.dumps(event['payload'])))
+        return event
+
+    def _record_events(self, cursor, events):
+        # Versión por lotes de _record_event: un solo INSERT de varias filas
+        if events:
+            cursor.executemany("INSERT INTO app_events (origin, user_id, kind, payload) VALUES (%s, %s, %s, %s)",
+                               [(event['origin'], event['user_id'], event['kind'], json.dumps(event['payload']))
+                                for event in events])
+
+    def get_last_app_event_id(self):
+        try:
+            with self.db_cursor() as cursor:
+                cursor.execute("SELECT COALESCE(MAX(id), 0) AS last_id FROM app_events")
+                return cursor.fetchone()['last_id']
+        except mysql.connector.Error as err:
+            logger.error(f"Error al obtener el último evento: {err}")
+            return None
+
+    def get_app_events(self, after_id, limit=500, missing_ids=()):
+        # missing_ids: ids por debajo de after_id que aún no se habían confirmado (IdWatermark)
+        condition = "id > %s"
+        if missing_ids:
+            condition += f" OR id IN ({', '.join(['%s'] * len(missing_ids))})"
+        try:
+            with self.db_cursor() as cursor:
+                cursor.execute(f"SELECT id, origin, user_id, kind, payload FROM app_events WHERE {condition} ORDER BY id LIMIT %s",
+                               (after_id, *missing_ids, limit))
+                return cursor.fetchall()
+        except mysql.connector.Error as err:
+            logger.error(f"Error al obtener eventos: {err}")
+            return []
+
+    def prune_app_events(self, max_age_hours=24):
+        try:
+            with self.db_cursor() as cursor:
+                cursor.execute("DELETE FROM app_events WHERE created_at < NOW() - INTERVAL %s HOUR", (max_age_hours,))
+        except mysql.connector.Error as err:
+            logger.error(f"Error al depurar eventos: {err}")
+
+    def _bump_counter(self, cursor, name, delta):
+        cursor.execute("INSERT INTO stats_counters (name, value) VALUES (%s, %s) "
+                       "ON DUPLICATE KEY UPDATE value = value + VALUES(value)", (name, delta))
+
+    def _bump_daily_attendance(self, cursor, day, delta):
+        cursor.execute("INSERT INTO stats_daily_attendance (day, total) VALUES (%s, %s) "
+                       "ON DUPLICATE KEY UPDATE total = total + VALUES(total)", (day, delta))
+
+    def _bump_revenue(self, cursor, payments, old_status, new_status):
+        # Mueve los pagos de la columna de old_status a la de new_status en stats_revenue_monthly
+        # (None = el pago no existía). Un solo INSERT de varias filas por transacción.
+        deltas = {}
+        for payment in payments:
+            month = payment['payment_date'].replace(day=1)
+            delta = deltas.setdefault((month, payment['payment_type']), [0, 0, 0, 0])
+            for status, sign in ((old_status, -1), (new_status, 1)):
+                if status == 'approved':
+                    delta[0] += sign
+                    delta[1] += sign * payment['amount']
+                elif status == 'rejected':
+                    delta[2] += sign
+                elif status == 'pending':
+                    delta[3] += sign
+        rows = [(month, payment_type, *delta) for (month, payment_type), delta in sorted(deltas.items()) if any(delta)]
+        if rows:
+            cursor.executemany("""
+                INSERT INTO stats_revenue_monthly
+                    (month, payment_type, approved_count, approved_amount, rejected_count, pending_count)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE
+                    approved_count = approved_count + VALUES(approved_count),
+                    approved_amount = approved_amount + VALUES(approved_amount),
+                    rejected_count = rejected_count + VALUES(rejected_count),
+                    pending_count = pending_count + VALUES(pending_count)
+            """, rows)
+
+    def _move_membership_expiry(self, cursor, old_end_date, new_end_date):
+        if str(old_end_date) == str(new_end_date):
+            return
+        if old_end_date:
+            cursor.execute("UPDATE stats_membership_expiry SET total = total - 1 WHERE end_date = %s", (old_end_date,))
+        if new_end_date:
+            cursor.execute("INSERT INTO stats_membership_expiry (end_date, total) VALUES (%s, 1) "
+                           "ON DUPLICATE KEY UPDATE total = total + 1", (new_end_date,))
+
+    def rebuild_statistics(self):
+        # Recalcula las tablas resumen (migración 3) desde cero; sirve para repararlas si se desincronizan
+        with self.db_cursor() as cursor:
+            for statement in STATS_ROLLUP_SQL:
+                cursor.execute(statement)
+            cursor.execute("DELETE FROM stats_revenue_monthly")
+            cursor.execute(REVENUE_ROLLUP_SQL)
+            cursor.execute("UPDATE users u "
+                           "LEFT JOIN (SELECT user_id, COUNT(*) AS total FROM notifications "
+                           "WHERE is_read = 0 GROUP BY user_id) n ON n.user_id = u.id "
+                           "SET u.unread_notifications = COALESCE(n.total, 0)")
+        logger.info("Estadísticas recalculadas")
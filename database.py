@@ -0,0 +1,129 @@
+import threading
+import time
+import logging
+from bisect import bisect_right
+from contextlib import contextmanager
+
+from mysql.connector import pooling
+from mysql.connector.errors import PoolError
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    """Pool acotado de conexiones MySQL.
+
+    Cada operación toma una conexión con ``connection()`` y la devuelve al
+    terminar. Si todas están ocupadas, la operación espera hasta
+    ``checkout_timeout`` segundos antes de fallar con ``PoolError``.
+    """
+
+    def __init__(self, db_config, pool_name="evolution_gym", pool_size=10, checkout_timeout=10):
+        self.pool_name = pool_name
+        self.pool_size = pool_size
+        self.checkout_timeout = checkout_timeout
+        self._pool = pooling.MySQLConnectionPool(pool_name=pool_name, pool_size=pool_size, **db_config)
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._peak_in_use = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._wait_time = 0.0
+
+    @contextmanager
+    def connection(self):
+        start = time.perf_counter()
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._waits += 1
+            if not self._slots.acquire(timeout=self.checkout_timeout):
+                with self._lock:
+                    self._timeouts += 1
+                logger.warning(f"Pool {self.pool_name} agotado tras {self.checkout_timeout}s de espera")
+                raise PoolError("Tiempo de espera agotado al obtener una conexión del pool")
+
+        try:
+            conn = self._pool.get_connection()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._checkouts += 1
+            self._wait_time += time.perf_counter() - start
+            self._in_use += 1
+            self._peak_in_use = max(self._peak_in_use, self._in_use)
+
+        try:
+            yield conn
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            conn.close()  # Devuelve la conexión al pool
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pool_name': self.pool_name,
+                'pool_size': self.pool_size,
+                'in_use': self._in_use,
+                'idle': self.pool_size - self._in_use,
+                'peak_in_use': self._peak_in_use,
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'timeouts': self._timeouts,
+                'avg_wait_ms': (self._wait_time / self._checkouts * 1000) if self._checkouts else 0.0,
+            }
+
+    def close(self):
+        closed = self._pool._remove_connections()
+        logger.info(f"Pool {self.pool_name} cerrado ({closed} conexiones)")
+
+
+class IdWatermark:
+    """Última fila leída de una tabla con id AUTO_INCREMENT, tolerando commits fuera de orden.
+
+    Los ids se asignan al insertar, no al hacer commit: una transacción larga
+    puede confirmar un id menor después de que otra haya confirmado uno
+    mayor. Por eso, además de ``id > last_id``, se vuelven a pedir los ids
+    que faltaban por debajo (``missing_ids``). Un hueco caduca en la primera
+    lectura posterior a ``grace`` segundos que tampoco lo trae: los de una
+    transacción deshecha no llegan nunca.
+    """
+
+    def __init__(self, last_id=0, grace=60.0, max_gaps=1000):
+        self.last_id = last_id
+        self.grace = grace
+        self.max_gaps = max_gaps
+        self._gaps = {}  # id -> instante en que se vio el hueco
+
+    def missing_ids(self):
+        return sorted(self._gaps)
+
+    def advance(self, ids):
+        """Registra los ids leídos (en orden ascendente) y los huecos que dejan por debajo."""
+        now = time.monotonic()
+        # Los huecos pedidos en esta lectura que siguen sin llegar tras el periodo de gracia caducan
+        self._gaps = {gap_id: seen for gap_id, seen in self._gaps.items() if now - seen < self.grace}
+        if len(ids) == 0:
+            return
+        # Los ids <= last_id solo pueden ser huecos que por fin se confirmaron
+        previous = self.last_id
+        filled = bisect_right(ids, previous)
+        for gap_id in ids[:filled]:
+            self._gaps.pop(int(gap_id), None)
+        if filled == len(ids):
+            return
+        newest = int(ids[-1])
+        # Solo se vigilan los max_gaps ids más recientes: un hueco antiguo no es una transacción en curso
+        horizon = max(previous, newest - self.max_gaps)
+        seen = {int(row_id) for row_id in ids[bisect_right(ids, horizon):]}
+        for gap_id in range(horizon + 1, newest):
+            if gap_id not in seen:
+                self._gaps[gap_id] = now
+        if len(self._gaps) > self.max_gaps:
+            self._gaps = dict(sorted(self._gaps.items())[-self.max_gaps:])
+        self.last_id = newest
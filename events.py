@@ -0,0 +1,135 @@
+import asyncio
+import json
+import logging
+import threading
+import uuid
+
+from database import IdWatermark
+
+logger = logging.getLogger(__name__)
+
+# Identifica los eventos publicados por este proceso en la tabla app_events
+PROCESS_ORIGIN = uuid.uuid4().hex
+# Origen de los eventos escritos por las tareas programadas; todos los procesos los reenvían
+SCHEDULER_ORIGIN = "scheduler"
+
+
+class EventBus:
+    """Publicación/suscripción en proceso, por id de usuario.
+
+    ``publish`` puede llamarse desde cualquier hilo (p. ej. los del executor de
+    la base de datos); cada manejador se ejecuta en el event loop en el que se
+    suscribió.
+    """
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id, handler):
+        """Suscribe un manejador async ``handler(event)``. Devuelve la función para cancelar la suscripción."""
+        user_id = int(user_id)
+        subscription = (asyncio.get_running_loop(), handler)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+
+        def unsubscribe():
+            with self._lock:
+                subscribers = self._subscribers.get(user_id)
+                if subscribers:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[user_id]
+
+        return unsubscribe
+
+    def has_subscribers(self):
+        with self._lock:
+            return bool(self._subscribers)
+
+    def publish(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(int(event['user_id']), ()))
+        for loop, handler in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._dispatch, handler, event)
+            except RuntimeError:  # el loop de la sesión ya se cerró
+                pass
+
+    def publish_all(self, events):
+        for event in events:
+            self.publish(event)
+
+    @staticmethod
+    def _dispatch(handler, event):
+        task = asyncio.ensure_future(handler(event))
+        task.add_done_callback(_log_handler_error)
+
+
+def _log_handler_error(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Error en un manejador de eventos: {task.exception()}")
+
+
+def make_event(user_id, kind, payload):
+    # El payload se normaliza a JSON para que los eventos locales y los reenviados sean idénticos
+    return {
+        'user_id': user_id,
+        'kind': kind,
+        'payload': json.loads(json.dumps(payload, default=str)),
+        'origin': PROCESS_ORIGIN,
+    }
+
+
+class EventRelay:
+    """Reenvía al EventBus local los eventos escritos en app_events por otros procesos.
+
+    La app del dueño y la del cliente se ejecutan en procesos distintos; una sola
+    consulta por clave primaria cada ``interval`` segundos sirve a todas las
+    sesiones del proceso. Los eventos de una transacción larga que confirma
+    después de otras más recientes se recogen durante ``gap_grace`` segundos.
+    """
+
+    def __init__(self, bus, interval=2.0, batch_size=500, prune_every=300, gap_grace=60.0):
+        self.bus = bus
+        self.interval = interval
+        self.batch_size = batch_size
+        self.prune_every = prune_every
+        self.gap_grace = gap_grace
+        self._task = None
+
+    def start(self, app):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(app))
+
+    async def _run(self, app):
+        last_id = await app.aio.get_last_app_event_id()
+        watermark = IdWatermark(last_id, grace=self.gap_grace) if last_id is not None else None
+        polls = 0
+        while True:
+            await asyncio.sleep(self.interval)
+            if watermark is None:
+                last_id = await app.aio.get_last_app_event_id()
+                if last_id is not None:
+                    watermark = IdWatermark(last_id, grace=self.gap_grace)
+                continue
+            try:
+                rows = await app.aio.get_app_events(watermark.last_id, self.batch_size, watermark.missing_ids())
+                watermark.advance([row['id'] for row in rows])
+                for row in rows:
+                    if row['origin'] != PROCESS_ORIGIN:
+                        self.bus.publish({
+                            'user_id': row['user_id'],
+                            'kind': row['kind'],
+                            'payload': json.loads(row['payload']),
+                            'origin': row['origin'],
+                        })
+                polls += 1
+                if polls % self.prune_every == 0:
+                    await app.aio.prune_app_events()
+            except Exception as e:
+                logger.error(f"Error al leer eventos de otros procesos: {e}")
+
+
+event_bus = EventBus()
+event_relay = EventRelay(event_bus)
@@ -0,0 +1,49 @@
+import csv
+import json
+import logging
+import os
+import sys
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+PAYMENT_EXPORT_COLUMNS = ['id', 'user_id', 'username', 'amount', 'payment_date', 'payment_type', 'status']
+
+
+def write_rows(rows, f, fmt, columns):
+    """Escribe las filas (un iterable) en ``f`` a medida que llegan. Devuelve cuántas se escribieron."""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Formato de exportación no admitido: {fmt}")
+    written = 0
+    if fmt == 'csv':
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            written += 1
+    else:
+        for row in rows:
+            f.write(json.dumps({column: row[column] for column in columns}, default=str, ensure_ascii=False))
+            f.write("\n")
+            written += 1
+    return written
+
+
+def export_to_file(rows, path, fmt, columns):
+    """Exporta a ``path`` (o a stdout si es "-") escribiendo en un temporal que se renombra al terminar."""
+    if path == "-":
+        return write_rows(rows, sys.stdout, fmt, columns)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+            written = write_rows(rows, f, fmt, columns)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    logger.info(f"Exportadas {written} filas a {path}")
+    return written
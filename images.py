@@ -0,0 +1,467 @@
+import os
+import io
+import hmac
+import shutil
+import hashlib
+import logging
+import secrets
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, quote, unquote
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow es opcional: sin él se muestran las imágenes originales
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Configuración de miniaturas y del servidor de imágenes
+image_config = {
+    'thumbnail_folder': 'thumbnails',
+    'thumbnail_size': (320, 320),
+    'thumbnail_quality': 80,
+    'memory_cache_bytes': 32 * 1024 * 1024,
+    # 'base64' incrusta las imágenes en la vista; 'url' las sirve desde AssetServer
+    'serve_mode': 'base64',
+    'asset_root': '.',
+    # Las URLs deben ser iguales en todos los procesos y tras reiniciar, o la caché del navegador no sirve:
+    # puerto fijo (el primer proceso que lo abre sirve a los demás) y clave de firma guardada en disco.
+    # Con los valores por defecto las URLs apuntan a 127.0.0.1 y solo las carga un navegador de esta misma
+    # máquina (app de escritorio). En Flet web con navegadores en otras máquinas hay que escuchar en
+    # '0.0.0.0' y poner en asset_base_url la dirección con la que esos navegadores llegan a este puerto
+    # (p. ej. "http://192.168.1.10:8552", o "https://gym.example.com/assets" tras un proxy). Si
+    # asset_base_url es None se usa http://asset_host:asset_port, con el nombre de la máquina en lugar de '0.0.0.0'
+    'asset_host': '127.0.0.1',
+    'asset_port': 8552,
+    'asset_base_url': None,
+    'asset_secret_file': '.asset_secret',
+    'asset_max_age': 31536000,
+    # Subida de imágenes: tamaño máximo y tamaño de cada bloque copiado
+    'max_upload_bytes': 10 * 1024 * 1024,
+    'upload_chunk_size': 256 * 1024,
+    # Almacén por contenido de comprobantes y promociones
+    'store_folder': 'image_store'
+}
+
+ASSET_CONTENT_TYPES = {
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.webp': 'image/webp',
+}
+
+
+class ImageTooLarge(Exception):
+    """La imagen supera ``image_config['max_upload_bytes']``."""
+
+    def __init__(self, size, max_bytes):
+        super().__init__(f"La imagen pesa {size} bytes y el máximo es {max_bytes}")
+        self.size = size
+        self.max_bytes = max_bytes
+
+
+def copy_image(source_path, destination_path, max_bytes=None, chunk_size=None, hasher=None):
+    """Copia la imagen por bloques a un temporal y lo renombra de forma atómica.
+
+    Nunca hay más de ``chunk_size`` bytes en memoria y el destino no queda a
+    medio escribir si la copia falla. Lanza ImageTooLarge si supera ``max_bytes``.
+    Si se pasa ``hasher`` (p. ej. ``hashlib.sha256()``) se actualiza con cada bloque.
+    Devuelve el número de bytes copiados.
+    """
+    max_bytes = image_config['max_upload_bytes'] if max_bytes is None else max_bytes
+    chunk_size = chunk_size or image_config['upload_chunk_size']
+    size = os.path.getsize(source_path)
+    if size > max_bytes:
+        raise ImageTooLarge(size, max_bytes)
+
+    tmp_path = f"{destination_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    copied = 0
+    try:
+        with open(source_path, 'rb') as src_file, open(tmp_path, 'wb') as dst_file:
+            while True:
+                chunk = src_file.read(chunk_size)
+                if not chunk:
+                    break
+                copied += len(chunk)
+                # El archivo puede crecer después del stat
+                if copied > max_bytes:
+                    raise ImageTooLarge(copied, max_bytes)
+                if hasher is not None:
+                    hasher.update(chunk)
+                dst_file.write(chunk)
+            dst_file.flush()
+            os.fsync(dst_file.fileno())
+        os.replace(tmp_path, destination_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return copied
+
+
+class ImageStore:
+    """Almacén de imágenes direccionado por contenido.
+
+    Cada imagen se guarda una sola vez en ``<root>/ab/cd/<sha256><ext>``; el
+    nombre depende solo del contenido, así que dos subidas iguales comparten
+    archivo y los archivos nunca cambian. Las referencias se cuentan en la
+    tabla image_blobs (ver ``CommonApp.upload_image``).
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path_for(self, digest, extension):
+        return os.path.join(self.root, digest[:2], digest[2:4], f"{digest}{extension}")
+
+    def digest_of(self, image_path):
+        """sha256 de una imagen del almacén, o None si la ruta no es del almacén."""
+        if not image_path:
+            return None
+        absolute_path = os.path.abspath(image_path)
+        if os.path.commonpath([os.path.abspath(self.root), absolute_path]) != os.path.abspath(self.root):
+            return None
+        digest = os.path.splitext(os.path.basename(absolute_path))[0]
+        return digest if len(digest) == 64 else None
+
+    def _temp_path(self, suffix):
+        staging_folder = os.path.join(self.root, 'tmp')
+        os.makedirs(staging_folder, exist_ok=True)
+        return os.path.join(staging_folder, f"{uuid.uuid4().hex}{suffix}")
+
+    def stage(self, source_path):
+        """Copia la imagen a un temporal del almacén calculando su hash. Devuelve (temporal, sha256, tamaño)."""
+        extension = os.path.splitext(source_path)[1].lower()
+        if extension not in ASSET_CONTENT_TYPES:
+            raise ValueError(f"Tipo de imagen no admitido: {extension}")
+        staged_path = self._temp_path(extension)
+        hasher = hashlib.sha256()
+        size = copy_image(source_path, staged_path, hasher=hasher)
+        return staged_path, hasher.hexdigest(), size
+
+    def commit(self, staged_path, final_path):
+        """Mueve el temporal a ``final_path`` (la ruta registrada en image_blobs), o lo descarta
+        si la imagen ya estaba guardada."""
+        if os.path.exists(final_path):
+            self.discard(staged_path)
+        else:
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.chmod(staged_path, 0o444)
+            os.replace(staged_path, final_path)
+        return final_path
+
+    def discard(self, staged_path):
+        try:
+            os.remove(staged_path)
+        except OSError:
+            pass
+
+    def remove(self, image_path):
+        try:
+            os.remove(image_path)
+        except FileNotFoundError:
+            pass
+
+    def trash(self, image_path):
+        """Aparta el archivo a un temporal (se borra con ``remove`` tras el commit). Devuelve su ruta o None."""
+        trash_path = self._temp_path(".deleted")
+        try:
+            os.replace(image_path, trash_path)
+        except FileNotFoundError:
+            return None
+        return trash_path
+
+    def restore(self, trash_path, image_path):
+        if trash_path is not None:
+            os.replace(trash_path, image_path)
+
+
+image_store = ImageStore(image_config['store_folder'])
+
+
+class ThumbnailCache:
+    """Miniaturas JPEG en disco con una caché LRU en memoria.
+
+    La clave es la ruta absoluta más el mtime de la imagen original, así que
+    si el archivo cambia se genera una miniatura nueva.
+    """
+
+    def __init__(self, folder, size=(320, 320), quality=80, memory_cache_bytes=32 * 1024 * 1024):
+        self.folder = folder
+        self.size = tuple(size)
+        self.quality = quality
+        self.memory_cache_bytes = memory_cache_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, image_path):
+        st = os.stat(image_path)
+        return f"{os.path.abspath(image_path)}:{st.st_mtime_ns}:{self.size[0]}x{self.size[1]}"
+
+    def _thumbnail_path(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.folder, digest[:2], f"{digest}.jpg")
+
+    def _remember(self, key, data):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = data
+            self._bytes += len(data)
+            while self._bytes > self.memory_cache_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def _render(self, image_path):
+        with Image.open(image_path) as img:
+            img.thumbnail(self.size)
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            buffer = io.BytesIO()
+            img.save(buffer, format="JPEG", quality=self.quality, optimize=True)
+            return buffer.getvalue()
+
+    def generate(self, image_path):
+        """Genera (si hace falta) la miniatura en disco y devuelve sus bytes, o None si no es posible."""
+        if Image is None:
+            return None
+        try:
+            key = self._key(image_path)
+            thumbnail_path = self._thumbnail_path(key)
+            if os.path.exists(thumbnail_path):
+                with open(thumbnail_path, "rb") as f:
+                    data = f.read()
+            else:
+                data = self._render(image_path)
+                os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+                tmp_path = f"{thumbnail_path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, thumbnail_path)
+            self._remember(key, data)
+            return data
+        except Exception as e:
+            logger.warning(f"No se pudo generar la miniatura de {image_path}: {e}")
+            return None
+
+    def get_path(self, image_path):
+        """Ruta en disco de la miniatura, generándola si hace falta."""
+        if Image is None:
+            return None
+        try:
+            thumbnail_path = self._thumbnail_path(self._key(image_path))
+        except OSError:
+            return None
+        if os.path.exists(thumbnail_path) or self.generate(image_path) is not None:
+            return thumbnail_path
+        return None
+
+    def get(self, image_path):
+        if Image is None:
+            return None
+        try:
+            key = self._key(image_path)
+        except OSError:
+            return None
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+            self.misses += 1
+        return self.generate(image_path)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+thumbnail_cache = ThumbnailCache(
+    image_config['thumbnail_folder'],
+    size=image_config['thumbnail_size'],
+    quality=image_config['thumbnail_quality'],
+    memory_cache_bytes=image_config['memory_cache_bytes'],
+)
+
+
+class _AssetRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def _serve(self, send_body):
+        url = urlsplit(self.path)
+        signature = parse_qs(url.query).get('sig', [''])[0]
+        file_path = self.server.assets.resolve(unquote(url.path.lstrip('/')), signature)
+        if file_path is None:
+            self.send_error(404)
+            return
+
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            self.send_error(404)
+            return
+
+        etag = f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+        headers = {
+            'ETag': etag,
+            'Last-Modified': formatdate(st.st_mtime, usegmt=True),
+            'Cache-Control': f"private, max-age={self.server.assets.max_age}, immutable",
+        }
+        if etag in (self.headers.get('If-None-Match') or ''):
+            self.send_response(304)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', ASSET_CONTENT_TYPES[os.path.splitext(file_path)[1].lower()])
+        self.send_header('Content-Length', str(st.st_size))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if send_body:
+            with open(file_path, 'rb') as f:
+                shutil.copyfileobj(f, self.wfile)
+
+    def log_message(self, format, *args):
+        logger.debug(f"AssetServer: {format % args}")
+
+
+def load_secret(path):
+    """Clave guardada en ``path``; la crea la primera vez. Todos los procesos leen la misma."""
+    try:
+        with open(path, 'rb') as f:
+            secret = f.read()
+        if secret:
+            return secret
+    except FileNotFoundError:
+        pass
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(secrets.token_bytes(32))
+    try:
+        os.link(temp_path, path)  # falla si otro proceso la creó a la vez: se usa la suya
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(temp_path)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class AssetServer:
+    """Servidor HTTP de imágenes con ETag y Cache-Control.
+
+    Las URLs llevan la versión del archivo (mtime) y una firma HMAC, de modo
+    que el navegador puede cachearlas indefinidamente y solo se sirven
+    archivos para los que la app generó una URL. Con un puerto fijo y la
+    clave en ``secret_file`` las URLs no cambian entre procesos ni al
+    reiniciar; si otro proceso ya tiene el puerto, él sirve las imágenes.
+    """
+
+    def __init__(self, root=".", host="127.0.0.1", port=0, base_url=None, max_age=31536000,
+                 secret_file=None, bind_retry=30.0):
+        self.root = os.path.abspath(root)
+        self.host = host
+        self.port = port
+        self.base_url = base_url
+        self.max_age = max_age
+        self.secret_file = secret_file
+        self.bind_retry = bind_retry
+        self._secret = None
+        self._server = None
+        self._next_bind = 0.0
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._server is not None or time.monotonic() < self._next_bind:
+                return
+            try:
+                self._server = ThreadingHTTPServer((self.host, self.port), _AssetRequestHandler)
+            except OSError as e:
+                if not self.port:
+                    raise
+                # El puerto es de otro proceso de la app (misma raíz y misma clave): se reintenta más tarde
+                # por si ese proceso termina
+                self._next_bind = time.monotonic() + self.bind_retry
+                logger.debug(f"Servidor de imágenes: puerto {self.port} ocupado ({e}), lo sirve otro proceso")
+            else:
+                self._server.daemon_threads = True
+                self._server.assets = self
+                self.port = self._server.server_address[1]
+                threading.Thread(target=self._server.serve_forever, name="asset-server", daemon=True).start()
+                logger.info(f"Servidor de imágenes escuchando en {self.host}:{self.port}")
+            if self.base_url is None:
+                self.base_url = f"http://{self._public_host()}:{self.port}"
+
+    def _public_host(self):
+        # Un navegador no puede pedir a 0.0.0.0: se anuncia el nombre de la máquina
+        return socket.getfqdn() if self.host in ('', '0.0.0.0') else self.host
+
+    def stop(self):
+        with self._lock:
+            if self._server is not None:
+                self._server.shutdown()
+                self._server.server_close()
+                self._server = None
+
+    def _sign(self, relative_path):
+        if self._secret is None:
+            self._secret = load_secret(self.secret_file) if self.secret_file else secrets.token_bytes(32)
+        return hmac.new(self._secret, relative_path.encode('utf-8'), hashlib.sha256).hexdigest()[:32]
+
+    def url_for(self, image_path):
+        """URL de la imagen, o None si está fuera de la raíz o no es un tipo servible."""
+        absolute_path = os.path.abspath(image_path)
+        relative_path = os.path.relpath(absolute_path, self.root).replace(os.sep, '/')
+        if relative_path.startswith('../') or os.path.splitext(relative_path)[1].lower() not in ASSET_CONTENT_TYPES:
+            return None
+        st = os.stat(absolute_path)
+        self.start()
+        return f"{self.base_url}/{quote(relative_path)}?v={st.st_mtime_ns:x}&sig={self._sign(relative_path)}"
+
+    def resolve(self, relative_path, signature):
+        if not hmac.compare_digest(self._sign(relative_path), signature):
+            return None
+        file_path = os.path.abspath(os.path.join(self.root, relative_path))
+        if os.path.commonpath([self.root, file_path]) != self.root:
+            return None
+        if os.path.splitext(file_path)[1].lower() not in ASSET_CONTENT_TYPES:
+            return None
+        return file_path
+
+
+asset_server = AssetServer(
+    image_config['asset_root'],
+    host=image_config['asset_host'],
+    port=image_config['asset_port'],
+    base_url=image_config['asset_base_url'],
+    max_age=image_config['asset_max_age'],
+    secret_file=image_config['asset_secret_file'],
+)
@@ -0,0 +1,317 @@
+import contextvars
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+instrumentation_config = {
+    'slow_query_ms': 100,         # a partir de aquí la consulta entra en el registro de lentas
+    'slow_query_log_size': 100,   # consultas lentas que se conservan (las más recientes)
+    # Límites superiores (ms) de los cubos del histograma de latencia
+    'buckets_ms': (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000),
+    # Endpoint /metrics para el agente local de Prometheus; cada app en su puerto
+    'metrics_host': '127.0.0.1',
+    'metrics_ports': {'owner': 9464, 'client': 9465}
+}
+
+# Ruta de la vista que originó la consulta; AsyncQueries la pasa a los hilos del executor
+current_route = contextvars.ContextVar('current_route', default=None)
+
+_STRING_LITERAL = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+_ROUTE_ID = re.compile(r"/\d+(?=/|$)")
+
+
+def normalize_sql(sql):
+    """SQL sin valores: literales y parámetros pasan a ``?`` y las listas IN (?, ?, ...) a ``(?+)``."""
+    if isinstance(sql, (bytes, bytearray)):
+        sql = sql.decode('utf-8', 'replace')
+    sql = _STRING_LITERAL.sub("?", sql)
+    sql = sql.replace("%s", "?")
+    sql = _NUMBER.sub("?", sql)
+    sql = _PLACEHOLDER_LIST.sub("(?+)", sql)
+    return _WHITESPACE.sub(" ", sql).strip()
+
+
+def route_label(route):
+    # /edit_user/42 -> /edit_user/:id, para no crear una serie por usuario
+    return _ROUTE_ID.sub("/:id", route) if route else route
+
+
+def set_route(route):
+    current_route.set(route_label(route))
+
+
+class _StatementStats:
+    __slots__ = ('sql', 'count', 'errors', 'total_ms', 'max_ms', 'rows', 'buckets')
+
+    def __init__(self, sql, bucket_count):
+        self.sql = sql
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.buckets = [0] * (bucket_count + 1)  # el último es +Inf
+
+
+class QueryMetrics:
+    """Latencias, filas y recuento por ruta de las consultas del proceso, más un registro de las lentas."""
+
+    def __init__(self, buckets_ms=(1, 5, 25, 100, 500, 2500), slow_query_ms=100, slow_query_log_size=100):
+        self.buckets_ms = tuple(buckets_ms)
+        self.slow_query_ms = slow_query_ms
+        self._statements = {}
+        self._routes = {}
+        self._slow_queries = deque(maxlen=slow_query_log_size)
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    def _bucket_index(self, elapsed_ms):
+        for i, limit in enumerate(self.buckets_ms):
+            if elapsed_ms <= limit:
+                return i
+        return len(self.buckets_ms)
+
+    def record(self, sql, elapsed_ms, rows=0, error=False, route=None):
+        normalized = normalize_sql(sql)
+        rows = max(rows, 0)  # -1: cursor sin buffer, las filas se suman en add_rows
+        route = route if route is not None else current_route.get()
+        with self._lock:
+            stats = self._statements.get(normalized)
+            if stats is None:
+                stats = self._statements[normalized] = _StatementStats(normalized, len(self.buckets_ms))
+            stats.count += 1
+            stats.errors += int(error)
+            stats.total_ms += elapsed_ms
+            stats.max_ms = max(stats.max_ms, elapsed_ms)
+            stats.rows += rows
+            stats.buckets[self._bucket_index(elapsed_ms)] += 1
+            route_stats = self._routes.setdefault(route or "(sin ruta)", [0, 0.0])
+            route_stats[0] += 1
+            route_stats[1] += elapsed_ms
+            if elapsed_ms >= self.slow_query_ms:
+                self._slow_queries.append({
+                    'at': datetime.now().isoformat(timespec='seconds'),
+                    'sql': normalized,
+                    'ms': round(elapsed_ms, 2),
+                    'rows': rows,
+                    'route': route,
+                })
+
+    def add_rows(self, sql, rows):
+        # Filas leídas después del execute (cursores sin buffer)
+        normalized = normalize_sql(sql)
+        with self._lock:
+            stats = self._statements.get(normalized)
+            if stats is not None:
+                stats.rows += rows
+
+    def reset(self):
+        with self._lock:
+            self._statements.clear()
+            self._routes.clear()
+            self._slow_queries.clear()
+            self.started_at = time.time()
+
+    def snapshot(self):
+        with self._lock:
+            statements = [{
+                'sql': stats.sql,
+                'count': stats.count,
+                'errors': stats.errors,
+                'total_ms': round(stats.total_ms, 2),
+                'avg_ms': round(stats.total_ms / stats.count, 2) if stats.count else 0.0,
+                'max_ms': round(stats.max_ms, 2),
+                'rows': stats.rows,
+                'buckets': list(stats.buckets),
+            } for stats in self._statements.values()]
+            routes = [{'route': route, 'queries': count, 'total_ms': round(total_ms, 2)}
+                      for route, (count, total_ms) in self._routes.items()]
+            slow_queries = list(reversed(self._slow_queries))
+        statements.sort(key=lambda stats: stats['total_ms'], reverse=True)
+        routes.sort(key=lambda stats: stats['total_ms'], reverse=True)
+        return {
+            'since': datetime.fromtimestamp(self.started_at).isoformat(timespec='seconds'),
+            'buckets_ms': list(self.buckets_ms),
+            'statements': statements,
+            'routes': routes,
+            'slow_queries': slow_queries,
+        }
+
+    def prometheus_text(self, gauges=None):
+        """Métricas en el formato de texto de Prometheus. ``gauges``: {nombre: valor} adicionales."""
+        snapshot = self.snapshot()
+        lines = [
+            "# HELP gym_db_query_duration_seconds Latencia de las sentencias SQL.",
+            "# TYPE gym_db_query_duration_seconds histogram",
+        ]
+        info_lines = [
+            "# HELP gym_db_query_info SQL normalizado de cada query_id.",
+            "# TYPE gym_db_query_info gauge",
+        ]
+        rows_lines = [
+            "# HELP gym_db_query_rows_total Filas devueltas o afectadas por las sentencias SQL.",
+            "# TYPE gym_db_query_rows_total counter",
+        ]
+        errors_lines = [
+            "# HELP gym_db_query_errors_total Sentencias SQL que terminaron con error.",
+            "# TYPE gym_db_query_errors_total counter",
+        ]
+        for stats in snapshot['statements']:
+            query_id = hashlib.sha1(stats['sql'].encode('utf-8')).hexdigest()[:12]
+            label = f'query_id="{query_id}"'
+            cumulative = 0
+            for limit, count in zip(list(self.buckets_ms) + [None], stats['buckets']):
+                cumulative += count
+                le = "+Inf" if limit is None else repr(limit / 1000)
+                lines.append(f'gym_db_query_duration_seconds_bucket{{{label},le="{le}"}} {cumulative}')
+            lines.append(f"gym_db_query_duration_seconds_sum{{{label}}} {stats['total_ms'] / 1000}")
+            lines.append(f"gym_db_query_duration_seconds_count{{{label}}} {stats['count']}")
+            info_lines.append(f'gym_db_query_info{{{label},sql="{_escape_label(stats["sql"])}"}} 1')
+            rows_lines.append(f"gym_db_query_rows_total{{{label}}} {stats['rows']}")
+            errors_lines.append(f"gym_db_query_errors_total{{{label}}} {stats['errors']}")
+        lines += info_lines + rows_lines + errors_lines
+        lines += [
+            "# HELP gym_route_queries_total Sentencias SQL por ruta de la app.",
+            "# TYPE gym_route_queries_total counter",
+        ]
+        lines += [f'gym_route_queries_total{{route="{_escape_label(route["route"])}"}} {route["queries"]}'
+                  for route in snapshot['routes']]
+        lines += [
+            "# HELP gym_route_query_seconds_total Tiempo en SQL por ruta de la app.",
+            "# TYPE gym_route_query_seconds_total counter",
+        ]
+        lines += [f'gym_route_query_seconds_total{{route="{_escape_label(route["route"])}"}} {route["total_ms"] / 1000}'
+                  for route in snapshot['routes']]
+        for name, value in (gauges or {}).items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class InstrumentedCursor:
+    """Envuelve un cursor de mysql.connector y registra cada sentencia en ``metrics``."""
+
+    def __init__(self, cursor, metrics):
+        self._cursor = cursor
+        self._metrics = metrics
+        self._statement = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def _timed(self, method, operation, *args, **kwargs):
+        self._statement = operation
+        start = time.perf_counter()
+        try:
+            result = method(operation, *args, **kwargs)
+        except Exception:
+            self._metrics.record(operation, (time.perf_counter() - start) * 1000, error=True)
+            raise
+        # Con buffer rowcount ya son las filas leídas; sin buffer se cuentan al hacer fetch
+        self._metrics.record(operation, (time.perf_counter() - start) * 1000, rows=self._cursor.rowcount)
+        return result
+
+    def execute(self, operation, params=(), *args, **kwargs):
+        return self._timed(self._cursor.execute, operation, params, *args, **kwargs)
+
+    def executemany(self, operation, seq_params, *args, **kwargs):
+        return self._timed(self._cursor.executemany, operation, seq_params, *args, **kwargs)
+
+    def fetchmany(self, size=None):
+        rows = self._cursor.fetchmany(size) if size is not None else self._cursor.fetchmany()
+        self._count_unbuffered(len(rows))
+        return rows
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._count_unbuffered(1)
+        return row
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._count_unbuffered(len(rows))
+        return rows
+
+    def _count_unbuffered(self, rows):
+        if rows and self._statement is not None and getattr(self._cursor, '_buffered', True) is False:
+            self._metrics.add_rows(self._statement, rows)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        try:
+            body = self.server.provider().encode('utf-8')
+        except Exception as e:
+            logger.error(f"Error al generar las métricas: {e}")
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"MetricsServer: {format % args}")
+
+
+class MetricsServer:
+    """Sirve ``provider()`` en /metrics para que lo lea un agente local."""
+
+    def __init__(self):
+        self.url = None
+        self._server = None
+        self._lock = threading.Lock()
+
+    def start(self, provider, host, port):
+        with self._lock:
+            if self._server is not None:
+                return True
+            try:
+                self._server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+            except OSError as e:
+                logger.warning(f"No se pudo abrir el endpoint de métricas en {host}:{port}: {e}")
+                return False
+            self._server.daemon_threads = True
+            self._server.provider = provider
+            self.url = f"http://{host}:{self._server.server_address[1]}/metrics"
+            threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True).start()
+            logger.info(f"Métricas disponibles en {self.url}")
+            return True
+
+    def stop(self):
+        with self._lock:
+            if self._server is not None:
+                self._server.shutdown()
+                self._server.server_close()
+                self._server = None
+                self.url = None
+
+
+query_metrics = QueryMetrics(
+    buckets_ms=instrumentation_config['buckets_ms'],
+    slow_query_ms=instrumentation_config['slow_query_ms'],
+    slow_query_log_size=instrumentation_config['slow_query_log_size'],
+)
+metrics_server = MetricsServer()
@@ -0,0 +1,135 @@
+import argparse
+import csv
+import sys
+from datetime import datetime
+
+from common import CommonApp
+import migrations
+from exports import EXPORT_FORMATS
+
+
+def rebuild_stats(app, args):
+    app.rebuild_statistics()
+    print("Estadísticas recalculadas")
+
+
+def migrate(app, args):
+    applied = migrations.migrate(app, target=args.target)
+    if applied:
+        print(f"Migraciones aplicadas: {', '.join(str(version) for version in applied)}")
+    else:
+        print("El esquema ya está actualizado")
+
+
+def schema_status(app, args):
+    for version, description, applied in migrations.schema_status(app):
+        print(f"{version:>4}  {'aplicada ' if applied else 'pendiente'}  {description}")
+
+
+def explain(app, args):
+    full_scans = 0
+    for row in migrations.explain_report(app):
+        flags = []
+        if row['full_scan']:
+            flags.append("RECORRIDO COMPLETO")
+            full_scans += 1
+        if row['filesort']:
+            flags.append("filesort")
+        print(f"{row['query']:<28} {str(row['table']):<14} {str(row['type']):<8} "
+              f"{str(row['key']):<32} {str(row['rows']):>8}  {' '.join(flags)}")
+    print(f"Consultas con recorrido completo: {full_scans}")
+
+
+def checkin_batch(app, args):
+    # CSV exportado por el torniquete: user_id,fecha_hora (ISO 8601). Una fila mal formada
+    # se informa como 'invalid' y no impide registrar las demás
+    entries = []
+    invalid = []
+    with open(args.file, newline='', encoding='utf-8') as f:
+        for row in csv.reader(f):
+            if not row:
+                continue
+            try:
+                entries.append((row[0], datetime.fromisoformat(row[1].strip())))
+            except (IndexError, ValueError):
+                invalid.append({'user_id': row[0], 'timestamp': ",".join(row[1:]), 'status': 'invalid',
+                                'remaining_days': None})
+    results = (app.record_attendance_bulk(entries) if entries else []) + invalid
+    by_status = {}
+    for result in results:
+        by_status[result['status']] = by_status.get(result['status'], 0) + 1
+        if result['status'] != 'recorded':
+            print(f"{result['user_id']},{result['timestamp']}: {result['status']}")
+    print(", ".join(f"{status}: {total}" for status, total in sorted(by_status.items())))
+
+
+def expire_memberships(app, args):
+    reminder_days = None
+    if args.reminder_days:
+        reminder_days = [int(days) for days in args.reminder_days.split(",")]
+    app.dry_run = args.dry_run
+    result = app.run_membership_maintenance(reminder_days=reminder_days)
+    print(f"Membresías vencidas: {result['expired']}, notificaciones enviadas: {result['notified']}"
+          + (" (simulación: cambios deshechos)" if args.dry_run else ""))
+
+
+def prune_images(app, args):
+    removed = app.prune_image_blobs(max_age_hours=args.max_age_hours)
+    print(f"Imágenes sin referencias borradas: {removed}")
+
+
+def export_payments(app, args):
+    fmt = args.format or ('jsonl' if args.output.endswith('.jsonl') else 'csv')
+    written = app.export_payment_history(args.output, fmt=fmt, chunk_size=args.chunk_size)
+    if args.output != "-":
+        print(f"Pagos exportados: {written} en {args.output}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tareas de mantenimiento de Evolution Gym")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("rebuild-stats", help="Recalcula las tablas resumen del panel del dueño")
+    migrate_parser = subparsers.add_parser("migrate", help="Crea o actualiza el esquema de la base de datos")
+    migrate_parser.add_argument("--target", type=int, help="Última versión a aplicar")
+    subparsers.add_parser("schema-status", help="Muestra las migraciones aplicadas y pendientes")
+    subparsers.add_parser("explain", help="Informe EXPLAIN de las consultas frecuentes")
+    checkin_parser = subparsers.add_parser("checkin-batch", help="Registra un lote de asistencias desde un CSV")
+    checkin_parser.add_argument("file", help="CSV con filas user_id,fecha_hora")
+    expire_parser = subparsers.add_parser("expire-memberships",
+                                          help="Vence membresías y envía recordatorios (ejecutar a diario desde cron)")
+    expire_parser.add_argument("--reminder-days", help="Días de antelación separados por comas, p. ej. 7,3,1")
+    expire_parser.add_argument("--dry-run", action="store_true",
+                               help="Ejecuta la tarea completa y deshace los cambios, para comprobarla")
+    prune_parser = subparsers.add_parser("prune-images", help="Borra las imágenes subidas que nadie usa")
+    prune_parser.add_argument("--max-age-hours", type=int, default=24, help="Antigüedad mínima en horas")
+    export_parser = subparsers.add_parser("export-payments", help="Exporta el historial de pagos a CSV o JSONL")
+    export_parser.add_argument("output", help='Archivo de salida ("-" para la salida estándar)')
+    export_parser.add_argument("--format", choices=EXPORT_FORMATS, help="Por defecto según la extensión del archivo")
+    export_parser.add_argument("--chunk-size", type=int, default=1000, help="Filas leídas del servidor por bloque")
+
+    args = parser.parse_args(argv)
+    commands = {
+        "rebuild-stats": rebuild_stats,
+        "migrate": migrate,
+        "schema-status": schema_status,
+        "explain": explain,
+        "checkin-batch": checkin_batch,
+        "expire-memberships": expire_memberships,
+        "prune-images": prune_images,
+        "export-payments": export_payments,
+    }
+
+    app = CommonApp()
+    if not app.connect_to_db():
+        print("No se pudo conectar a la base de datos")
+        return 1
+    try:
+        commands[args.command](app, args)
+    finally:
+        app.close_db_connection()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
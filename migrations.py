@@ -0,0 +1,305 @@
+import logging
+from datetime import date, timedelta
+
+import queries as sql
+
+logger = logging.getLogger(__name__)
+
+
+def add_index(table, name, columns):
+    """Paso de migración que crea un índice salvo que ya exista uno equivalente.
+
+    MySQL no admite ``CREATE INDEX IF NOT EXISTS``; se considera equivalente
+    cualquier índice cuyas primeras columnas sean ``columns``.
+    """
+    wanted = ",".join(columns)
+
+    def step(cursor):
+        cursor.execute("""
+            SELECT index_name AS index_name,
+                   GROUP_CONCAT(column_name ORDER BY seq_in_index) AS index_columns
+            FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = %s
+            GROUP BY index_name
+        """, (table,))
+        for row in cursor.fetchall():
+            if row['index_name'] == name or (row['index_columns'] + ",").startswith(wanted + ","):
+                logger.info(f"Índice {name} omitido: {table} ya tiene {row['index_name']} ({row['index_columns']})")
+                return
+        cursor.execute(f"CREATE INDEX {name} ON {table} ({', '.join(columns)})")
+
+    step.description = f"CREATE INDEX {name} ON {table} ({', '.join(columns)})"
+    return step
+
+
+def add_column(table, name, definition):
+    """Paso de migración que añade una columna si la tabla aún no la tiene."""
+
+    def step(cursor):
+        cursor.execute("""
+            SELECT COUNT(*) AS total FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+        """, (table, name))
+        if cursor.fetchone()['total']:
+            logger.info(f"Columna {table}.{name} omitida: ya existe")
+            return
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+    step.description = f"ALTER TABLE {table} ADD COLUMN {name} {definition}"
+    return step
+
+
+# Recalcula las tablas resumen del panel del dueño (migración 3 y CommonApp.rebuild_statistics)
+STATS_ROLLUP_SQL = [
+    "DELETE FROM stats_counters",
+    "INSERT INTO stats_counters (name, value) SELECT 'total_users', COUNT(*) FROM users",
+    "INSERT INTO stats_counters (name, value) "
+    "SELECT 'total_income', COALESCE(SUM(amount), 0) FROM payments WHERE status = 'approved'",
+    "DELETE FROM stats_daily_attendance",
+    "INSERT INTO stats_daily_attendance (day, total) "
+    "SELECT attendance_date, COUNT(*) FROM attendances GROUP BY attendance_date",
+    "DELETE FROM stats_membership_expiry",
+    "INSERT INTO stats_membership_expiry (end_date, total) "
+    "SELECT membership_end_date, COUNT(*) FROM users "
+    "WHERE membership_end_date IS NOT NULL GROUP BY membership_end_date",
+]
+
+# Recalcula stats_revenue_monthly desde payments (migración 9 y CommonApp.rebuild_statistics)
+REVENUE_ROLLUP_SQL = """
+    INSERT INTO stats_revenue_monthly
+        (month, payment_type, approved_count, approved_amount, rejected_count, pending_count)
+    SELECT DATE_FORMAT(payment_date, '%Y-%m-01'), payment_type,
+           SUM(status = 'approved'), COALESCE(SUM(IF(status = 'approved', amount, 0)), 0),
+           SUM(status = 'rejected'), SUM(status = 'pending')
+    FROM payments
+    GROUP BY DATE_FORMAT(payment_date, '%Y-%m-01'), payment_type
+"""
+
+# (versión, descripción, pasos). Cada paso es SQL o una función que recibe el cursor.
+# Los pasos deben ser idempotentes: en MySQL el DDL hace commit implícito.
+MIGRATIONS = [
+    (1, "Esquema inicial", [
+        """CREATE TABLE IF NOT EXISTS users (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            username VARCHAR(50) NOT NULL UNIQUE,
+            password VARCHAR(255) NOT NULL,
+            membership_type VARCHAR(20) NULL,
+            membership_start_date DATE NULL,
+            membership_end_date DATE NULL,
+            remaining_days INT NOT NULL DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS owners (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            username VARCHAR(50) NOT NULL UNIQUE,
+            password VARCHAR(255) NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS payments (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id INT NOT NULL,
+            amount DECIMAL(10, 2) NOT NULL,
+            payment_date DATE NOT NULL,
+            payment_type VARCHAR(20) NOT NULL,
+            image_path VARCHAR(255) NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS attendances (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id INT NOT NULL,
+            attendance_date DATE NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS notifications (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id INT NOT NULL,
+            message TEXT NOT NULL,
+            sent_at DATETIME NOT NULL,
+            is_read TINYINT(1) NOT NULL DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS promotions (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            title VARCHAR(255) NOT NULL,
+            description TEXT NOT NULL,
+            image_path VARCHAR(255) NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )""",
+    ]),
+    (2, "Índices para las consultas frecuentes", [
+        add_index("users", "idx_users_username", ["username"]),
+        add_index("users", "idx_users_membership_end", ["membership_end_date"]),
+        add_index("payments", "idx_payments_status_date", ["status", "payment_date"]),
+        add_index("attendances", "idx_attendances_user_date", ["user_id", "attendance_date"]),
+        add_index("notifications", "idx_notifications_user_unread", ["user_id", "is_read", "sent_at"]),
+        add_index("promotions", "idx_promotions_created", ["created_at"]),
+    ]),
+    (3, "Tablas resumen del panel del dueño", [
+        """CREATE TABLE IF NOT EXISTS stats_counters (
+            name VARCHAR(50) PRIMARY KEY,
+            value DECIMAL(14, 2) NOT NULL DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS stats_daily_attendance (
+            day DATE PRIMARY KEY,
+            total INT NOT NULL DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS stats_membership_expiry (
+            end_date DATE PRIMARY KEY,
+            total INT NOT NULL DEFAULT 0
+        )""",
+        *STATS_ROLLUP_SQL,
+    ]),
+    (4, "Eventos para las sesiones abiertas de otros procesos", [
+        """CREATE TABLE IF NOT EXISTS app_events (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            origin CHAR(32) NOT NULL,
+            user_id INT NOT NULL,
+            kind VARCHAR(30) NOT NULL,
+            payload TEXT NOT NULL,
+            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            INDEX idx_app_events_created (created_at)
+        )""",
+    ]),
+    (5, "Contador de notificaciones sin leer por usuario", [
+        add_column("users", "unread_notifications", "INT NOT NULL DEFAULT 0"),
+        """UPDATE users u
+           LEFT JOIN (SELECT user_id, COUNT(*) AS total FROM notifications
+                      WHERE is_read = 0 GROUP BY user_id) n ON n.user_id = u.id
+           SET u.unread_notifications = COALESCE(n.total, 0)""",
+    ]),
+    (6, "Registro de las tareas programadas", [
+        """CREATE TABLE IF NOT EXISTS scheduled_jobs (
+            name VARCHAR(50) PRIMARY KEY,
+            last_run DATE NULL,
+            finished_at DATETIME NULL
+        )""",
+    ]),
+    (7, "Almacén de imágenes por contenido", [
+        """CREATE TABLE IF NOT EXISTS image_blobs (
+            sha256 CHAR(64) PRIMARY KEY,
+            path VARCHAR(255) NOT NULL,
+            size BIGINT NOT NULL,
+            ref_count INT NOT NULL DEFAULT 0,
+            created_at DATETIME NOT NULL,
+            INDEX idx_image_blobs_unused (ref_count, created_at)
+        )""",
+        add_index("payments", "idx_payments_image", ["image_path"]),
+    ]),
+    (8, "Índices del historial de pagos filtrado", [
+        add_index("payments", "idx_payments_date", ["payment_date"]),
+        add_index("payments", "idx_payments_user_date", ["user_id", "payment_date"]),
+        add_index("payments", "idx_payments_type_date", ["payment_type", "payment_date"]),
+    ]),
+    (9, "Resumen mensual de ingresos por tipo de pago", [
+        """CREATE TABLE IF NOT EXISTS stats_revenue_monthly (
+            month DATE NOT NULL,
+            payment_type VARCHAR(20) NOT NULL,
+            approved_count INT NOT NULL DEFAULT 0,
+            approved_amount DECIMAL(14, 2) NOT NULL DEFAULT 0,
+            rejected_count INT NOT NULL DEFAULT 0,
+            pending_count INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (month, payment_type)
+        )""",
+        "DELETE FROM stats_revenue_monthly",
+        REVENUE_ROLLUP_SQL,
+    ]),
+    (10, "Hora de las asistencias", [
+        add_column("attendances", "attended_at", "DATETIME NULL"),
+    ]),
+]
+
+
+# Consultas de CommonApp/OwnerApp revisadas por explain_report (nombre, SQL, parámetros de ejemplo).
+# El SQL sale de queries.py, el mismo que ejecutan los métodos.
+_SAMPLE_DAY = date(2024, 1, 31)
+
+HOT_QUERIES = [
+    ("login (users)", sql.USER_BY_USERNAME_SQL, ("demo",)),
+    ("login (owners)", sql.OWNER_BY_USERNAME_SQL, ("demo",)),
+    ("get_pending_payments", sql.PENDING_PAYMENTS_SQL, ()),
+    ("get_attendance_history",
+     *sql.attendance_history_query(1, start_date="2024-01-01", end_date="2024-01-31")),
+    ("get_attendance_history (página)", *sql.attendance_history_query(1, limit=30)),
+    ("get_monthly_attendance_counts", sql.MONTHLY_ATTENDANCE_COUNTS_SQL, (1, "2024-01-01")),
+    ("get_notifications", *sql.notifications_query(1)),
+    ("get_notifications (página)", *sql.notifications_query(1, before=("2024-01-31 00:00:00", 100))),
+    ("get_unread_count", sql.UNREAD_COUNT_SQL, (1,)),
+    ("get_promotions", sql.PROMOTIONS_SQL, ()),
+    ("get_revenue_rollup", *sql.revenue_rollup_query("2020-01-01")),
+    ("get_cached_promotions (carga)", sql.CACHED_PROMOTIONS_SQL, ()),
+    ("find_payment_by_image", sql.PAYMENT_BY_IMAGE_SQL, ("image_store/ab/cd/abcd.png",)),
+    ("iter_attendance_chunks", *sql.attendance_chunks_query(0)),
+    ("get_remaining_days", sql.REMAINING_DAYS_SQL, (1,)),
+    ("vencimientos (recordatorios)",
+     *sql.membership_reminders_query(_SAMPLE_DAY, _SAMPLE_DAY - timedelta(days=1), (7,))),
+    ("vencimientos (saldo a cero)", sql.EXPIRE_MEMBERSHIPS_SQL, (_SAMPLE_DAY,)),
+    ("get_statistics", sql.STATISTICS_SQL, ()),
+    ("get_users (por id)", *sql.users_page_query(0, 50)),
+    ("get_users (por nombre)", *sql.users_page_query(("a", 0), 50, "username")),
+    ("get_payment_history (página)", *sql.payment_history_query(limit=50)),
+    ("get_payment_history (usuario)", *sql.payment_history_query({'username': "ana"}, 50)),
+    ("get_payment_history (estado y fechas)",
+     *sql.payment_history_query({'status': "approved", 'date_from': "2024-03-01", 'date_to': "2024-03-31"},
+                                50, ("2024-03-20", 1000))),
+]
+
+
+def ensure_migrations_table(cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INT PRIMARY KEY,
+        description VARCHAR(255) NOT NULL,
+        applied_at DATETIME NOT NULL
+    )""")
+
+
+def applied_versions(app):
+    with app.db_cursor() as cursor:
+        ensure_migrations_table(cursor)
+        cursor.execute("SELECT version FROM schema_migrations")
+        return {row['version'] for row in cursor.fetchall()}
+
+
+def migrate(app, target=None):
+    """Aplica en orden las migraciones pendientes hasta ``target`` (o todas). Devuelve las versiones aplicadas."""
+    applied = applied_versions(app)
+    newly_applied = []
+    for version, description, steps in MIGRATIONS:
+        if version in applied or (target is not None and version > target):
+            continue
+        logger.info(f"Aplicando migración {version}: {description}")
+        with app.db_cursor() as cursor:
+            for step in steps:
+                if callable(step):
+                    step(cursor)
+                else:
+                    cursor.execute(step)
+            cursor.execute("INSERT INTO schema_migrations (version, description, applied_at) VALUES (%s, %s, NOW())",
+                           (version, description))
+        newly_applied.append(version)
+    return newly_applied
+
+
+def schema_status(app):
+    applied = applied_versions(app)
+    return [(version, description, version in applied) for version, description, _ in MIGRATIONS]
+
+
+def explain_report(app, queries=HOT_QUERIES):
+    """Ejecuta EXPLAIN sobre cada consulta y marca los recorridos completos de tabla o de índice."""
+    report = []
+    with app.db_cursor() as cursor:
+        for name, query, params in queries:
+            cursor.execute(f"EXPLAIN {query}", params)
+            for row in cursor.fetchall():
+                access_type = row.get('type')
+                extra = row.get('Extra') or ''
+                report.append({
+                    'query': name,
+                    'table': row.get('table'),
+                    'type': access_type,
+                    'key': row.get('key'),
+                    'rows': row.get('rows'),
+                    'extra': extra,
+                    'full_scan': access_type in ('ALL', 'index'),
+                    'filesort': 'filesort' in extra,
+                })
+    return report
@@ -3,8 +3,13 @@ from common import CommonApp
 import os
 from datetime import datetime, timedelta
 import logging
-import bcrypt
 import mysql.connector
+from passwords import PasswordServiceBusy
+from events import event_bus
+from images import ImageTooLarge
+import analytics
+from instrumentation import set_route, query_metrics
+import queries
 
 # Configuración de logging
 logging.basicConfig(level=logging.INFO)
@@ -13,9 +18,9 @@ logger = logging.getLogger(__name__)
 class OwnerApp(CommonApp):
     def get_pending_payments(self):
         try:
-            self.ensure_connection()
-            self.cursor.execute("SELECT p.*, u.username FROM payments p JOIN users u ON p.user_id = u.id WHERE p.status = 'pending' ORDER BY p.payment_date DESC")
-            payments = self.cursor.fetchall()
+            with self.db_cursor() as cursor:
+                cursor.execute(queries.PENDING_PAYMENTS_SQL)
+                payments = cursor.fetchall()
             logger.info(f"Pagos pendientes recuperados: {len(payments)}")
             return payments
         except mysql.connector.Error as err:
@@ -23,9 +28,9 @@ class OwnerApp(CommonApp):
             return []
     def __init__(self):
         super().__init__()
-        self.payment_images_folder = "payment_images"
-        self.promotion_images_folder = "promotion_images"
         self.selected_file = None
+        self.users_page_size = 50
+        self.payments_page_size = 50
 
     async def show_edit_user_dialog(self, page, user):
         membership_type = ft.Dropdown(
@@ -41,7 +46,7 @@ class OwnerApp(CommonApp):
 
         async def save_changes(e):
             try:
-                success = self.update_user(
+                success = await self.aio.update_user(
                     user['id'],
                     membership_type.value,
                     end_date.value,
@@ -76,7 +81,7 @@ class OwnerApp(CommonApp):
 
     async def edit_user_view(self, page: ft.Page):
         user_id = int(page.route.split('/')[-1])
-        user = self.get_user_by_id(user_id)
+        user = await self.aio.get_user_by_id(user_id)
         if not user:
             return ft.View("/edit_user", [ft.Text("Usuario no encontrado")])
 
@@ -93,7 +98,7 @@ class OwnerApp(CommonApp):
 
         async def save_changes(e):
             try:
-                success = self.update_user(
+                success = await self.aio.update_user(
                     user['id'],
                     membership_type.value,
                     end_date.value,
@@ -124,13 +129,15 @@ class OwnerApp(CommonApp):
 
     async def main(self, page: ft.Page):
         self.page = page
-        self.connect_to_db()
+        await self.aio.connect_to_db()
+        self.start_metrics_server("owner")
         page.title = "Evolution Gym - Dueño"
         page.theme_mode = ft.ThemeMode.LIGHT
         page.window_width = 375
         page.window_height = 812
 
         async def route_change(route):
+            set_route(page.route)
             page.views.clear()
             if page.route == "/":
                 page.views.append(await self.login_view(page))
@@ -150,6 +157,10 @@ class OwnerApp(CommonApp):
                 page.views.append(await self.manage_users_view(page))
             elif page.route == "/payment_history":
                 page.views.append(await self.payment_history_view(page))
+            elif page.route == "/analytics":
+                page.views.append(await self.analytics_view(page))
+            elif page.route == "/diagnostics":
+                page.views.append(await self.diagnostics_view(page))
             await page.update_async()
 
         page.on_route_change = route_change
@@ -165,16 +176,17 @@ class OwnerApp(CommonApp):
                 return
 
             try:
-                self.cursor.execute("SELECT * FROM owners WHERE username = %s", (username.value,))
-                owner = self.cursor.fetchone()
+                owner = await self.aio.get_owner_by_username(username.value)
                 logger.info(f"Intento de inicio de sesión para el usuario: {username.value}")
                 logger.info(f"Dueño encontrado en la base de datos: {owner is not None}")
                 
-                if owner and 'password' in owner and bcrypt.checkpw(password.value.encode('utf-8'), owner['password'].encode('utf-8')):
+                if owner and 'password' in owner and await self.check_credentials(owner, password.value, "owners"):
                     self.current_user = owner
                     await page.go_async("/dashboard")
                 else:
                     page.show_snack_bar(ft.SnackBar(ft.Text("Credenciales incorrectas")))
+            except PasswordServiceBusy:
+                page.show_snack_bar(ft.SnackBar(ft.Text("Servidor ocupado. Por favor, intenta de nuevo en unos segundos.")))
             except mysql.connector.Error as err:
                 logger.error(f"Error en el inicio de sesión: {err}")
                 page.show_snack_bar(ft.SnackBar(ft.Text("Error en el inicio de sesión. Por favor, intenta de nuevo.")))
@@ -194,7 +206,7 @@ class OwnerApp(CommonApp):
             ],
         )
     async def dashboard_view(self, page: ft.Page):
-        stats = self.get_statistics()
+        stats = await self.aio.get_statistics()
 
         async def go_to_manage_payments(_):
             await page.go_async("/manage_payments")
@@ -208,6 +220,12 @@ class OwnerApp(CommonApp):
         async def go_to_payment_history(_):
             await page.go_async("/payment_history")
 
+        async def go_to_analytics(_):
+            await page.go_async("/analytics")
+
+        async def go_to_diagnostics(_):
+            await page.go_async("/diagnostics")
+
         return ft.View(
             "/dashboard",
             [
@@ -221,44 +239,12 @@ class OwnerApp(CommonApp):
                     ft.ElevatedButton("Subir Promoción", on_click=go_to_upload_promotion),
                     ft.ElevatedButton("Gestionar Usuarios", on_click=go_to_manage_users),
                     ft.ElevatedButton("Historial de Pagos", on_click=go_to_payment_history),
+                    ft.ElevatedButton("Analíticas", on_click=go_to_analytics),
+                    ft.ElevatedButton("Diagnóstico", on_click=go_to_diagnostics),
                 ], alignment=ft.MainAxisAlignment.CENTER, horizontal_alignment=ft.CrossAxisAlignment.CENTER)
             ]
         )
 
-    async def manage_payments_view(self, page: ft.Page):
-        pending_payments = self.get_pending_payments()
-        logger.info(f"Número de pagos pendientes: {len(pending_payments)}")
-        payment_list = ft.Column(scroll=ft.ScrollMode.AUTO)
-
-        if not pending_payments:
-            logger.info("No hay pagos pendientes")
-            payment_list.controls.append(ft.Text("No hay pagos pendientes"))
-        else:
-            for payment in pending_payments:
-                logger.info(f"Procesando pago: {payment}")
-                payment_item = ft.Column([
-                    ft.Text(f"Usuario: {payment['username']}"),
-                    ft.Text(f"Monto: ${payment['amount']}"),
-                    ft.Text(f"Tipo: {payment['payment_type']}"),
-                    ft.Text(f"Fecha: {payment['payment_date']}"),
-                    self.show_image(payment['image_path']),
-                    ft.Row([
-                        ft.ElevatedButton("Aprobar", on_click=lambda _, p=payment, pi=payment_item: self.approve_payment(p, pi)),
-                        ft.ElevatedButton("Rechazar", on_click=lambda _, p=payment, pi=payment_item: self.reject_payment(p, pi)),
-                    ])
-                ])
-                payment_list.controls.append(payment_item)
-
-        return ft.View(
-            "/manage_payments",
-            [
-                ft.AppBar(title=ft.Text("Gestionar Pagos")),
-                payment_list,
-                ft.ElevatedButton("Volver", on_click=lambda _: page.go("/dashboard"))
-            ]
-        )
-
-
     async def upload_promotion_view(self, page: ft.Page):
         title = ft.TextField(label="Título de la promoción")
         description = ft.TextField(label="Descripción", multiline=True)
@@ -272,10 +258,15 @@ class OwnerApp(CommonApp):
                 return
 
             try:
-                destination_path = self.upload_image(self.selected_file, self.promotion_images_folder)
-                self.add_promotion(title.value, description.value, destination_path)
+                destination_path = await self.aio.upload_image(self.selected_file)
+                if destination_path is None:
+                    raise IOError("No se pudo copiar la imagen")
+                await self.aio.add_promotion(title.value, description.value, destination_path)
                 page.show_snack_bar(ft.SnackBar(ft.Text("Promoción subida exitosamente")))
                 await page.go_async("/dashboard")
+            except ImageTooLarge as e:
+                page.show_snack_bar(ft.SnackBar(ft.Text(
+                    f"La imagen es demasiado grande (máximo {e.max_bytes // (1024 * 1024)} MB)")))
             except Exception as e:
                 logger.error(f"Error al subir la promoción: {e}")
                 page.show_snack_bar(ft.SnackBar(ft.Text("Error al subir la promoción")))
@@ -296,45 +287,102 @@ class OwnerApp(CommonApp):
         )
 
     async def manage_payments_view(self, page: ft.Page):
-        pending_payments = self.get_pending_payments()
+        pending_payments = await self.aio.get_pending_payments()
         logger.info(f"Número de pagos pendientes: {len(pending_payments)}")
         payment_list = ft.Column(scroll=ft.ScrollMode.AUTO)
+        payment_items = {}
+        selected_ids = set()
+        selection_text = ft.Text()
+        select_all = ft.Checkbox(label="Seleccionar todos")
+        approve_selected_button = ft.ElevatedButton("Aprobar seleccionados", disabled=True)
+        reject_selected_button = ft.ElevatedButton("Rechazar seleccionados", disabled=True)
+
+        def refresh_selection():
+            selection_text.value = f"{len(selected_ids)} de {len(payment_items)} seleccionados"
+            approve_selected_button.disabled = not selected_ids
+            reject_selected_button.disabled = not selected_ids
+            select_all.value = bool(payment_items) and len(selected_ids) == len(payment_items)
+            if not payment_items:
+                payment_list.controls = [ft.Text("No hay pagos pendientes")]
+
+        async def review(payment_ids, status):
+            # Un solo lote por clic; se quitan de la lista solo los pagos procesados
+            reviewed = await self.aio.review_payments(payment_ids, status)
+            if reviewed is None:
+                page.show_snack_bar(ft.SnackBar(ft.Text("Error al procesar los pagos")))
+                return
+            # Los que ya no estaban pendientes los procesó otra sesión: también se quitan
+            for payment_id in payment_ids:
+                item = payment_items.pop(payment_id, None)
+                if item is not None:
+                    payment_list.controls.remove(item)
+                selected_ids.discard(payment_id)
+            refresh_selection()
+            status_text = "aprobados" if status == 'approved' else "rechazados"
+            page.show_snack_bar(ft.SnackBar(ft.Text(f"Pagos {status_text}: {len(reviewed)}")))
+            await page.update_async()
 
-        if not pending_payments:
-            logger.info("No hay pagos pendientes")
-            payment_list.controls.append(ft.Text("No hay pagos pendientes"))
-        else:
-            for payment in pending_payments:
-                logger.info(f"Procesando pago: {payment}")
-                
-                def create_button(payment, action):
-                    async def handle_click(_):
-                        if action == "approve":
-                            await self.approve_payment(payment, payment_item)
-                        else:
-                            await self.reject_payment(payment, payment_item)
-                    return ft.ElevatedButton(
-                        "Aprobar" if action == "approve" else "Rechazar",
-                        on_click=handle_click
-                    )
+        async def approve_selected(_):
+            await review(sorted(selected_ids), 'approved')
+
+        async def reject_selected(_):
+            await review(sorted(selected_ids), 'rejected')
+
+        async def on_select_all(e):
+            selected_ids.clear()
+            if select_all.value:
+                selected_ids.update(payment_items)
+            for payment_id, item in payment_items.items():
+                item.controls[0].value = payment_id in selected_ids
+            refresh_selection()
+            await page.update_async()
+
+        def create_checkbox(payment_id):
+            async def on_change(e):
+                if e.control.value:
+                    selected_ids.add(payment_id)
+                else:
+                    selected_ids.discard(payment_id)
+                refresh_selection()
+                await page.update_async()
+            return ft.Checkbox(on_change=on_change)
+
+        def create_button(payment, action):
+            async def handle_click(_):
+                await review([payment['id']], 'approved' if action == "approve" else 'rejected')
+            return ft.ElevatedButton(
+                "Aprobar" if action == "approve" else "Rechazar",
+                on_click=handle_click
+            )
+
+        select_all.on_change = on_select_all
+        approve_selected_button.on_click = approve_selected
+        reject_selected_button.on_click = reject_selected
 
-                payment_item = ft.Column([
+        for payment in pending_payments:
+            payment_item = ft.Row([
+                create_checkbox(payment['id']),
+                ft.Column([
                     ft.Text(f"Usuario: {payment['username']}"),
                     ft.Text(f"Monto: ${payment['amount']}"),
                     ft.Text(f"Tipo: {payment['payment_type']}"),
                     ft.Text(f"Fecha: {payment['payment_date']}"),
-                    self.show_image(payment['image_path']),
+                    await self.aio.show_thumbnail(payment['image_path'], page),
                     ft.Row([
                         create_button(payment, "approve"),
                         create_button(payment, "reject")
                     ])
                 ])
-                payment_list.controls.append(payment_item)
+            ], vertical_alignment=ft.CrossAxisAlignment.START)
+            payment_items[payment['id']] = payment_item
+            payment_list.controls.append(payment_item)
+        refresh_selection()
 
         return ft.View(
             "/manage_payments",
             [
                 ft.AppBar(title=ft.Text("Gestionar Pagos")),
+                ft.Row([select_all, selection_text, approve_selected_button, reject_selected_button], wrap=True),
                 payment_list,
                 ft.ElevatedButton("Volver", on_click=lambda _: page.go("/dashboard"))
             ]
@@ -342,25 +390,78 @@ class OwnerApp(CommonApp):
 
     async def manage_users_view(self, page: ft.Page):
         try:
-            users = self.get_users()
-            user_list = ft.Column(scroll=ft.ScrollMode.AUTO)
-
-            for user in users:
-                user_item = ft.Column([
-                    ft.Text(f"Usuario: {user['username']}"),
-                    ft.Text(f"Tipo de membresía: {user['membership_type']}"),
-                    ft.Text(f"Fecha de fin: {user['membership_end_date']}"),
-                    ft.Text(f"Días restantes: {user['remaining_days']}"),
-                    ft.ElevatedButton("Editar", on_click=lambda _, u=user: self.edit_user(page, u)),
-                    ft.Divider(),
-                ])
-                user_list.controls.append(user_item)
+            # Paginación por clave: cada página continúa después del último usuario cargado.
+            # generation cambia con el orden; las cargas lanzadas antes se descartan al terminar
+            state = {'after': None, 'done': False, 'loading': False, 'generation': 0}
+            order_by = ft.Dropdown(
+                label="Ordenar por",
+                value="id",
+                options=[
+                    ft.dropdown.Option("id", "Fecha de registro"),
+                    ft.dropdown.Option("username", "Nombre de usuario"),
+                ],
+            )
+            user_list = ft.ListView(expand=True, on_scroll_interval=100)
+            load_more_button = ft.TextButton("Cargar más", visible=False)
+
+            def create_user_item(user):
+                return ft.ListTile(
+                    title=ft.Text(f"Usuario: {user['username']}"),
+                    subtitle=ft.Text(
+                        f"Tipo de membresía: {user['membership_type']}\n"
+                        f"Fecha de fin: {user['membership_end_date']}\n"
+                        f"Días restantes: {user['remaining_days']}"
+                    ),
+                    is_three_line=True,
+                    trailing=ft.ElevatedButton("Editar", on_click=lambda _, u=user: self.edit_user(page, u)),
+                )
+
+            async def load_next_page():
+                if state['loading'] or state['done']:
+                    return
+                generation, sort = state['generation'], order_by.value
+                state['loading'] = True
+                try:
+                    users = await self.aio.get_users(after=state['after'], limit=self.users_page_size, order_by=sort)
+                    if generation != state['generation']:
+                        return
+                    user_list.controls.extend(create_user_item(user) for user in users)
+                    if users:
+                        last = users[-1]
+                        state['after'] = (last['username'], last['id']) if sort == "username" else last['id']
+                    state['done'] = len(users) < self.users_page_size
+                    load_more_button.visible = not state['done']
+                finally:
+                    if generation == state['generation']:
+                        state['loading'] = False
+
+            async def on_scroll(e: ft.OnScrollEvent):
+                if e.pixels >= e.max_scroll_extent - 200 and not state['done']:
+                    await load_next_page()
+                    await page.update_async()
+
+            async def on_load_more(_):
+                await load_next_page()
+                await page.update_async()
+
+            async def on_order_change(_):
+                state.update(after=None, done=False, loading=False, generation=state['generation'] + 1)
+                user_list.controls.clear()
+                await load_next_page()
+                await page.update_async()
+
+            user_list.on_scroll = on_scroll
+            load_more_button.on_click = on_load_more
+            order_by.on_change = on_order_change
+            await load_next_page()
 
             return ft.View(
                 "/manage_users",
                 [
                     ft.AppBar(title=ft.Text("Gestionar Usuarios")),
+                    order_by,
                     user_list,
+                    load_more_button,
                     ft.ElevatedButton("Volver", on_click=lambda _: page.go("/dashboard"))
                 ]
             )
@@ -380,11 +481,45 @@ class OwnerApp(CommonApp):
 
 
     async def payment_history_view(self, page: ft.Page):
-        payments = self.get_payment_history()
-        payment_list = ft.Column(scroll=ft.ScrollMode.AUTO)
-
-        for payment in payments:
-            payment_item = ft.Column([
+        # Filtros aplicados en el servidor y paginación por clave (payment_date, id).
+        # generation cambia con los filtros; las cargas lanzadas antes se descartan al terminar
+        state = {'filters': {}, 'before': None, 'done': False, 'loading': False, 'generation': 0}
+        username_filter = ft.TextField(label="Usuario", width=160)
+        status_filter = ft.Dropdown(label="Estado", width=140, value="", options=[
+            ft.dropdown.Option("", "Todos"),
+            ft.dropdown.Option("pending", "Pendiente"),
+            ft.dropdown.Option("approved", "Aprobado"),
+            ft.dropdown.Option("rejected", "Rechazado"),
+        ])
+        type_filter = ft.Dropdown(label="Tipo", width=120, value="", options=[
+            ft.dropdown.Option("", "Todos"),
+            ft.dropdown.Option("normal"),
+            ft.dropdown.Option("full"),
+        ])
+        date_from_filter = ft.TextField(label="Desde (AAAA-MM-DD)", width=170)
+        date_to_filter = ft.TextField(label="Hasta (AAAA-MM-DD)", width=170)
+        amount_min_filter = ft.TextField(label="Monto mínimo", width=130)
+        amount_max_filter = ft.TextField(label="Monto máximo", width=130)
+        payment_list = ft.ListView(expand=True, on_scroll_interval=100)
+        load_more_button = ft.TextButton("Cargar más", visible=False)
+        page_size = self.payments_page_size
+
+        def read_filters():
+            def parse(field, convert):
+                value = (field.value or "").strip()
+                return convert(value) if value else None
+            return {
+                'username': (username_filter.value or "").strip() or None,
+                'status': status_filter.value or None,
+                'payment_type': type_filter.value or None,
+                'date_from': parse(date_from_filter, lambda v: datetime.strptime(v, "%Y-%m-%d").date()),
+                'date_to': parse(date_to_filter, lambda v: datetime.strptime(v, "%Y-%m-%d").date()),
+                'amount_min': parse(amount_min_filter, float),
+                'amount_max': parse(amount_max_filter, float),
+            }
+
+        def create_payment_item(payment):
+            return ft.Column([
                 ft.Text(f"Usuario: {payment['username']}"),
                 ft.Text(f"Monto: ${payment['amount']}"),
                 ft.Text(f"Fecha: {payment['payment_date']}"),
@@ -392,17 +527,312 @@ class OwnerApp(CommonApp):
                 ft.Text(f"Estado: {payment['status']}"),
                 ft.Divider(),
             ])
-            payment_list.controls.append(payment_item)
+
+        async def load_next_page():
+            if state['loading'] or state['done']:
+                return
+            generation = state['generation']
+            state['loading'] = True
+            try:
+                payments = await self.aio.get_payment_history(filters=state['filters'], limit=page_size,
+                                                              before=state['before'])
+                if generation != state['generation']:
+                    return
+                if payments is None:
+                    page.show_snack_bar(ft.SnackBar(ft.Text("No se pudo cargar el historial de pagos")))
+                    load_more_button.visible = True
+                    return
+                payment_list.controls.extend(create_payment_item(payment) for payment in payments)
+                if payments:
+                    state['before'] = (payments[-1]['payment_date'], payments[-1]['id'])
+                elif not payment_list.controls:
+                    payment_list.controls.append(ft.Text("No hay pagos con estos filtros"))
+                state['done'] = len(payments) < page_size
+                load_more_button.visible = not state['done']
+            finally:
+                if generation == state['generation']:
+                    state['loading'] = False
+
+        async def apply_filters(_):
+            try:
+                filters = read_filters()
+            except ValueError:
+                page.show_snack_bar(ft.SnackBar(ft.Text("Revisa los filtros: fechas AAAA-MM-DD y montos numéricos")))
+                return
+            state.update(filters=filters, before=None, done=False, loading=False, generation=state['generation'] + 1)
+            payment_list.controls.clear()
+            await load_next_page()
+            await page.update_async()
+
+        async def clear_filters(e):
+            for field in (username_filter, date_from_filter, date_to_filter, amount_min_filter, amount_max_filter):
+                field.value = ""
+            status_filter.value = ""
+            type_filter.value = ""
+            await apply_filters(e)
+
+        async def on_scroll(e: ft.OnScrollEvent):
+            if e.pixels >= e.max_scroll_extent - 200 and not state['done']:
+                await load_next_page()
+                await page.update_async()
+
+        async def on_load_more(_):
+            await load_next_page()
+            await page.update_async()
+
+        payment_list.on_scroll = on_scroll
+        load_more_button.on_click = on_load_more
+        await load_next_page()
+
+        # Exportación para contabilidad con los filtros aplicados: se escribe por bloques desde el servidor
+        export_state = {'format': 'csv'}
+
+        async def on_export_path(e: ft.FilePickerResultEvent):
+            if not e.path:
+                return
+            try:
+                written = await self.aio.export_payment_history(e.path, fmt=export_state['format'],
+                                                                filters=state['filters'])
+                page.show_snack_bar(ft.SnackBar(ft.Text(f"Pagos exportados: {written}")))
+            except Exception as ex:
+                logger.error(f"Error al exportar el historial de pagos: {ex}")
+                page.show_snack_bar(ft.SnackBar(ft.Text("Error al exportar el historial de pagos")))
+
+        export_picker = ft.FilePicker(on_result=on_export_path)
+        page.overlay.append(export_picker)
+
+        def create_export_button(fmt):
+            def pick_export_path(_):
+                export_state['format'] = fmt
+                export_picker.save_file(file_name=f"pagos_{datetime.now():%Y%m%d}.{fmt}", allowed_extensions=[fmt])
+            return ft.ElevatedButton(f"Exportar {fmt.upper()}", on_click=pick_export_path)
 
         return ft.View(
             "/payment_history",
             [
                 ft.AppBar(title=ft.Text("Historial de Pagos")),
+                ft.Row([
+                    username_filter, status_filter, type_filter, date_from_filter, date_to_filter,
+                    amount_min_filter, amount_max_filter,
+                    ft.ElevatedButton("Filtrar", on_click=apply_filters),
+                    ft.TextButton("Limpiar", on_click=clear_filters),
+                ], wrap=True),
+                ft.Row([create_export_button('csv'), create_export_button('jsonl')]),
                 payment_list,
+                load_more_button,
+                ft.ElevatedButton("Volver", on_click=lambda _: page.go("/dashboard"))
+            ]
+        )
+
+    async def analytics_view(self, page: ft.Page):
+        rows = await self.aio.get_revenue_rollup()
+        report = analytics.revenue_report(rows)
+
+        def format_rate(rate):
+            return "-" if rate != rate else f"{rate:.0%}"  # NaN: sin pagos revisados
+
+        if report is None:
+            revenue_section = ft.Text("Instala NumPy para ver las analíticas" if analytics.np is None
+                                      else "Todavía no hay pagos")
+        else:
+            type_columns = [ft.DataColumn(ft.Text(payment_type.capitalize()), numeric=True)
+                            for payment_type in report['payment_types']]
+            revenue_rows = [
+                ft.DataRow(cells=[
+                    ft.DataCell(ft.Text(month)),
+                    *[ft.DataCell(ft.Text(f"{amount:.2f}")) for amount in report['revenue'][i]],
+                    ft.DataCell(ft.Text(f"{report['total_revenue'][i]:.2f}")),
+                    ft.DataCell(ft.Text(f"{int(report['approved'][i])}/{int(report['rejected'][i])}/{int(report['pending'][i])}")),
+                    ft.DataCell(ft.Text(format_rate(report['approval_rate'][i]))),
+                ])
+                for i, month in reversed(list(enumerate(report['months'])))
+            ]
+            revenue_section = ft.Column([
+                ft.Text(
+                    f"Ingresos aprobados: {report['total_revenue'].sum():.2f} · "
+                    + " · ".join(f"{payment_type}: {amount:.2f}"
+                                 for payment_type, amount in zip(report['payment_types'], report['revenue_by_type']))
+                    + f" · Tasa de aprobación: {format_rate(report['overall_approval_rate'])}"
+                ),
+                ft.DataTable(
+                    columns=[
+                        ft.DataColumn(ft.Text("Mes")),
+                        *type_columns,
+                        ft.DataColumn(ft.Text("Total"), numeric=True),
+                        ft.DataColumn(ft.Text("Aprob./Rech./Pend.")),
+                        ft.DataColumn(ft.Text("Tasa de aprobación"), numeric=True),
+                    ],
+                    rows=revenue_rows,
+                ),
+            ])
+
+        # Ocupación: mapa de calor día × hora y visitas por socio en la ventana elegida
+        occupancy_section = ft.Column()
+        weeks_selector = ft.Dropdown(label="Periodo", value="4", width=180, options=[
+            ft.dropdown.Option("4", "Últimas 4 semanas"),
+            ft.dropdown.Option("12", "Últimas 12 semanas"),
+            ft.dropdown.Option("52", "Último año"),
+        ])
+
+        def create_heatmap(heatmap):
+            peak = max(int(heatmap.max()), 1)
+            header = ft.Row([ft.Container(width=36)] + [
+                ft.Container(ft.Text(str(hour), size=9), width=18, alignment=ft.alignment.center)
+                for hour in range(24)
+            ], spacing=2)
+            rows = [
+                ft.Row([ft.Container(ft.Text(name, size=11), width=36)] + [
+                    ft.Container(
+                        width=18, height=18, border_radius=2,
+                        bgcolor=ft.colors.with_opacity(0.05 + 0.95 * int(count) / peak, ft.colors.BLUE),
+                        tooltip=f"{name} {hour}:00 · {int(count)} asistencias",
+                    )
+                    for hour, count in enumerate(heatmap[weekday])
+                ], spacing=2)
+                for weekday, name in enumerate(analytics.WEEKDAY_NAMES)
+            ]
+            return ft.Column([header] + rows, spacing=2)
+
+        async def show_occupancy(weeks):
+            occupancy = await self.aio.get_attendance_analytics(weeks=weeks)
+            if occupancy is None:
+                occupancy_section.controls = [ft.Text("Instala NumPy para ver las analíticas" if analytics.np is None
+                                                      else "Todavía no hay asistencias")]
+                return
+            peak_visits = max(int(occupancy['frequency_distribution'].max()), 1)
+            occupancy_section.controls = [
+                ft.Text(f"Asistencias: {occupancy['total_visits']} · Socios activos: {occupancy['active_members']} · "
+                        f"Visitas por socio: {occupancy['mean_visits']:.1f}"
+                        + (f" · Sin hora registrada: {occupancy['visits_without_time']}"
+                           if occupancy['visits_without_time'] else "")),
+                create_heatmap(occupancy['heatmap']),
+                ft.Text("Visitas por socio", weight=ft.FontWeight.BOLD),
+                *[
+                    ft.Row([
+                        ft.Container(ft.Text(label), width=50),
+                        ft.Container(width=200 * int(total) / peak_visits, height=14, bgcolor=ft.colors.GREEN),
+                        ft.Text(str(int(total))),
+                    ])
+                    for label, total in zip(occupancy['frequency_labels'], occupancy['frequency_distribution'])
+                ],
+            ]
+
+        async def on_weeks_change(_):
+            await show_occupancy(int(weeks_selector.value))
+            await page.update_async()
+
+        weeks_selector.on_change = on_weeks_change
+        await show_occupancy(int(weeks_selector.value))
+
+        return ft.View(
+            "/analytics",
+            [
+                ft.AppBar(title=ft.Text("Analíticas")),
+                ft.Column([
+                    ft.Text("Ingresos por mes", style="headlineSmall", weight=ft.FontWeight.BOLD),
+                    revenue_section,
+                    ft.Divider(),
+                    ft.Text("Ocupación por día y hora", style="headlineSmall", weight=ft.FontWeight.BOLD),
+                    weeks_selector,
+                    occupancy_section,
+                ], scroll=ft.ScrollMode.AUTO, expand=True),
                 ft.ElevatedButton("Volver", on_click=lambda _: page.go("/dashboard"))
             ]
         )
 
+    async def diagnostics_view(self, page: ft.Page):
+        content = ft.Column(scroll=ft.ScrollMode.AUTO, expand=True)
+
+        def create_sql_text(sql):
+            return ft.Text(sql if len(sql) <= 120 else sql[:117] + "...", size=11, selectable=True, tooltip=sql)
+
+        async def show_diagnostics():
+            diagnostics = await self.aio.get_diagnostics()
+            pool = diagnostics['pool']
+            promotions = diagnostics['promotions_cache']
+            thumbnails = diagnostics['thumbnail_cache']
+            content.controls = [
+                ft.Text(f"Métricas desde {diagnostics['since']} · Endpoint: {diagnostics['metrics_url'] or 'no disponible'}"),
+                ft.Text(
+                    f"Pool: {pool.get('in_use', 0)}/{pool.get('pool_size', 0)} en uso · pico {pool.get('peak_in_use', 0)} · "
+                    f"esperas {pool.get('waits', 0)} · agotado {pool.get('timeouts', 0)} · "
+                    f"espera media {pool.get('avg_wait_ms', 0.0):.1f} ms"
+                ),
+                ft.Text(
+                    f"Caché de promociones: {promotions['hits']} aciertos / {promotions['misses']} fallos · "
+                    f"Miniaturas: {thumbnails['hits']} aciertos / {thumbnails['misses']} fallos"
+                ),
+                ft.Divider(),
+                ft.Text("Consultas por ruta", style="headlineSmall", weight=ft.FontWeight.BOLD),
+                ft.DataTable(
+                    columns=[
+                        ft.DataColumn(ft.Text("Ruta")),
+                        ft.DataColumn(ft.Text("Consultas"), numeric=True),
+                        ft.DataColumn(ft.Text("Tiempo (ms)"), numeric=True),
+                    ],
+                    rows=[
+                        ft.DataRow(cells=[
+                            ft.DataCell(ft.Text(route['route'])),
+                            ft.DataCell(ft.Text(str(route['queries']))),
+                            ft.DataCell(ft.Text(f"{route['total_ms']:.1f}")),
+                        ])
+                        for route in diagnostics['routes']
+                    ],
+                ),
+                ft.Divider(),
+                ft.Text("Sentencias por tiempo total", style="headlineSmall", weight=ft.FontWeight.BOLD),
+                ft.DataTable(
+                    columns=[
+                        ft.DataColumn(ft.Text("SQL")),
+                        ft.DataColumn(ft.Text("Veces"), numeric=True),
+                        ft.DataColumn(ft.Text("Media (ms)"), numeric=True),
+                        ft.DataColumn(ft.Text("Máx. (ms)"), numeric=True),
+                        ft.DataColumn(ft.Text("Filas"), numeric=True),
+                        ft.DataColumn(ft.Text("Errores"), numeric=True),
+                    ],
+                    rows=[
+                        ft.DataRow(cells=[
+                            ft.DataCell(create_sql_text(statement['sql'])),
+                            ft.DataCell(ft.Text(str(statement['count']))),
+                            ft.DataCell(ft.Text(f"{statement['avg_ms']:.1f}")),
+                            ft.DataCell(ft.Text(f"{statement['max_ms']:.1f}")),
+                            ft.DataCell(ft.Text(str(statement['rows']))),
+                            ft.DataCell(ft.Text(str(statement['errors']))),
+                        ])
+                        for statement in diagnostics['statements'][:20]
+                    ],
+                ),
+                ft.Divider(),
+                ft.Text(f"Consultas lentas (≥ {query_metrics.slow_query_ms} ms)", style="headlineSmall", weight=ft.FontWeight.BOLD),
+                *([ft.ListTile(
+                    title=create_sql_text(slow['sql']),
+                    subtitle=ft.Text(f"{slow['at']} · {slow['ms']:.1f} ms · {slow['rows']} filas · {slow['route'] or '-'}"),
+                ) for slow in diagnostics['slow_queries']] or [ft.Text("Ninguna")]),
+            ]
+
+        async def refresh(_):
+            await show_diagnostics()
+            await page.update_async()
+
+        async def reset_metrics(_):
+            query_metrics.reset()
+            await show_diagnostics()
+            await page.update_async()
+
+        await show_diagnostics()
+
+        return ft.View(
+            "/diagnostics",
+            [
+                ft.AppBar(title=ft.Text("Diagnóstico")),
+                ft.Row([
+                    ft.ElevatedButton("Actualizar", on_click=refresh),
+                    ft.ElevatedButton("Reiniciar métricas", on_click=reset_metrics),
+                ]),
+                content,
+                ft.ElevatedButton("Volver", on_click=lambda _: page.go("/dashboard"))
+            ]
+        )
 
     def on_file_selected(self, e: ft.FilePickerResultEvent):
         if e.files:
@@ -412,39 +842,52 @@ class OwnerApp(CommonApp):
 
     def get_statistics(self):
         try:
-            self.ensure_connection()
-            stats = {}
-
-            # Total de usuarios
-            self.cursor.execute("SELECT COUNT(*) AS total_users FROM users")
-            row = self.cursor.fetchone()
-            stats['total_users'] = row.get('total_users', 0)
-
-            # Usuarios activos (con membresía vigente)
-            self.cursor.execute("SELECT COUNT(*) AS active_users FROM users WHERE membership_end_date >= CURDATE()")
-            row = self.cursor.fetchone()
-            stats['active_users'] = row.get('active_users', 0)
-
-            # Total de ingresos (pagos aprobados)
-            self.cursor.execute("SELECT SUM(amount) AS total_income FROM payments WHERE status = 'approved'")
-            row = self.cursor.fetchone()
-            stats['total_income'] = row.get('total_income', 0)
-
-            # Asistencias del último mes
-            self.cursor.execute("SELECT COUNT(*) AS monthly_attendances FROM attendances WHERE attendance_date >= DATE_SUB(CURDATE(), INTERVAL 1 MONTH)")
-            row = self.cursor.fetchone()
-            stats['monthly_attendances'] = row.get('monthly_attendances', 0)
-
-            return stats
+            # Lectura de las tablas resumen (ver CommonApp.rebuild_statistics)
+            with self.db_cursor() as cursor:
+                cursor.execute(queries.STATISTICS_SQL)
+                row = cursor.fetchone()
+
+            return {
+                'total_users': int(row['total_users']),
+                'active_users': int(row['active_users']),
+                'total_income': row['total_income'],
+                'monthly_attendances': int(row['monthly_attendances']),
+            }
         except mysql.connector.Error as err:
             logger.error(f"Error al obtener estadísticas: {err}")
             return {}
 
-    def get_users(self):
+    def get_revenue_rollup(self, since=None):
+        # Filas de stats_revenue_monthly (una por mes y tipo de pago), mantenidas al aprobar/rechazar
+        query, params = queries.revenue_rollup_query(since)
+        try:
+            with self.db_cursor() as cursor:
+                cursor.execute(query, params)
+                return cursor.fetchall()
+        except mysql.connector.Error as err:
+            logger.error(f"Error al obtener el resumen de ingresos: {err}")
+            return []
+
+    def get_attendance_analytics(self, weeks=4):
+        # Lee solo las asistencias nuevas desde la última llamada y calcula sobre las columnas en memoria
+        try:
+            analytics.attendance_analytics.refresh(self.iter_attendance_chunks)
+        except mysql.connector.Error as err:
+            logger.error(f"Error al leer las asistencias para las analíticas: {err}")
+        return analytics.attendance_analytics.report(weeks=weeks)
+
+    def get_owner_by_username(self, username):
+        with self.db_cursor() as cursor:
+            cursor.execute(queries.OWNER_BY_USERNAME_SQL, (username,))
+            return cursor.fetchone()
+
+    def get_users(self, after=None, limit=None, order_by="id"):
+        # after: último id visto, o (username, id) si se ordena por nombre de usuario
+        query, params = queries.users_page_query(after, limit, order_by)
         try:
-            self.ensure_connection()
-            self.cursor.execute("SELECT id, username, membership_type, membership_end_date, remaining_days FROM users")
-            users = self.cursor.fetchall()
+            with self.db_cursor() as cursor:
+                cursor.execute(query, params)
+                users = cursor.fetchall()
             logger.info(f"Obtenidos {len(users)} usuarios")
             return users
         except mysql.connector.Error as err:
@@ -453,28 +896,34 @@ class OwnerApp(CommonApp):
 
     def update_user(self, user_id, membership_type, end_date, remaining_days):
         try:
-            self.ensure_connection()
-            self.cursor.execute("UPDATE users SET membership_type = %s, membership_end_date = %s, remaining_days = %s WHERE id = %s",
-                                (membership_type, end_date, remaining_days, user_id))
-            self.conn.commit()
+            with self.db_cursor() as cursor:
+                cursor.execute("SELECT membership_end_date FROM users WHERE id = %s FOR UPDATE", (user_id,))
+                previous = cursor.fetchone()
+                cursor.execute("UPDATE users SET membership_type = %s, membership_end_date = %s, remaining_days = %s WHERE id = %s",
+                               (membership_type, end_date, remaining_days, user_id))
+                if previous:
+                    self._move_membership_expiry(cursor, previous['membership_end_date'], end_date)
+                event = self._record_event(cursor, user_id, 'membership', {
+                    'membership_type': membership_type,
+                    'membership_end_date': end_date,
+                    'remaining_days': remaining_days,
+                })
+            event_bus.publish(event)
             return True
         except mysql.connector.Error as err:
             logger.error(f"Error al actualizar usuario: {err}")
             return False
 
-    def get_payment_history(self):
+    def get_payment_history(self, filters=None, limit=None, before=None):
+        # filters: ver queries.payment_history_conditions; before=(payment_date, id) de la última fila de la página anterior
+        query, params = queries.payment_history_query(filters, limit, before)
         try:
-            self.ensure_connection()
-            self.cursor.execute("""
-                SELECT p.id, u.username, p.amount, p.payment_date, p.payment_type, p.status
-                FROM payments p
-                JOIN users u ON p.user_id = u.id
-                ORDER BY p.payment_date DESC
-            """)
-            return self.cursor.fetchall()
+            with self.db_cursor() as cursor:
+                cursor.execute(query, params)
+                return cursor.fetchall()
         except mysql.connector.Error as err:
             logger.error(f"Error al obtener historial de pagos: {err}")
-            return []
+            return None
 
     async def show_edit_user_dialog(self, page, user):
         membership_type = ft.Dropdown(
@@ -490,7 +939,7 @@ class OwnerApp(CommonApp):
 
         async def save_changes(e):
             try:
-                success = self.update_user(
+                success = await self.aio.update_user(
                     user['id'],
                     membership_type.value,
                     end_date.value,
@@ -523,26 +972,6 @@ class OwnerApp(CommonApp):
         dlg.open = True
         await page.update_async()
 
-    async def approve_payment(self, payment, payment_item):
-        try:
-            logger.info(f"Aprobando pago: {payment['id']}")
-            self.update_payment_status(payment['id'], 'approved')
-            
-            # Convertir los valores a los tipos correctos
-            user_id = int(payment['user_id'])
-            payment_type = str(payment['payment_type'])
-            amount = float(payment['amount'])
-            
-            self.update_membership(user_id, payment_type, amount)
-            
-            payment_list = self.page.views[-1].controls[1]
-            payment_list.controls.remove(payment_item)
-            await self.page.update_async()
-            self.page.show_snack_bar(ft.SnackBar(ft.Text("Pago aprobado exitosamente")))
-        except Exception as e:
-            logger.error(f"Error al aprobar el pago: {e}")
-            self.page.show_snack_bar(ft.SnackBar(ft.Text("Error al aprobar el pago")))                    
-
 if __name__ == "__main__":
     ft.app(target=OwnerApp().main)
 
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+logger = logging.getLogger(__name__)
+
+# Configuración del hash de contraseñas
+password_config = {
+    'workers': 2,           # procesos dedicados a bcrypt
+    'max_concurrent': 2,    # operaciones bcrypt en curso a la vez
+    'max_queue': 32,        # operaciones en espera antes de rechazar nuevas
+    'queue_timeout': 10,    # segundos máximos de espera en la cola
+    'rounds': 12            # coste objetivo de los hashes
+}
+
+
+class PasswordServiceBusy(Exception):
+    pass
+
+
+def _hashpw(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _checkpw(password, hashed):
+    return bcrypt.checkpw(password, hashed)
+
+
+def hash_rounds(hashed):
+    # Formato bcrypt: $2b$<coste>$<sal+hash>
+    try:
+        return int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    """Ejecuta bcrypt en un pool de procesos acotado.
+
+    Como mucho ``max_concurrent`` operaciones se ejecutan a la vez; el resto
+    espera en cola. Si la cola supera ``max_queue`` o la espera supera
+    ``queue_timeout`` se lanza ``PasswordServiceBusy`` en lugar de seguir
+    acumulando trabajo.
+    """
+
+    def __init__(self, workers=2, max_concurrent=None, max_queue=32, queue_timeout=10, rounds=12):
+        self.workers = workers
+        self.max_concurrent = max_concurrent or workers
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.rounds = rounds
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._semaphore = None
+        self._pending = 0
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    async def _run(self, func, *args):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+
+        if self._pending >= self.max_concurrent + self.max_queue:
+            logger.warning(f"Cola de contraseñas llena ({self._pending} operaciones pendientes)")
+            raise PasswordServiceBusy("Demasiadas operaciones de contraseña en curso")
+
+        self._pending += 1
+        try:
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Tiempo de espera agotado en la cola de contraseñas ({self.queue_timeout}s)")
+                raise PasswordServiceBusy("Tiempo de espera agotado en la cola de contraseñas")
+
+            try:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._get_executor(), func, *args)
+            finally:
+                self._semaphore.release()
+        finally:
+            self._pending -= 1
+
+    async def hash(self, password):
+        return await self._run(_hashpw, password.encode('utf-8'), self.rounds)
+
+    async def verify(self, password, hashed):
+        return await self._run(_checkpw, password.encode('utf-8'), hashed.encode('utf-8'))
+
+    def needs_rehash(self, hashed):
+        return hash_rounds(hashed) != self.rounds
+
+    async def verify_and_rehash(self, password, hashed):
+        """Devuelve ``(válida, nuevo_hash)``; ``nuevo_hash`` es None si no hace falta actualizarlo."""
+        if not await self.verify(password, hashed):
+            return False, None
+        if self.needs_rehash(hashed):
+            return True, await self.hash(password)
+        return True, None
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'max_concurrent': self.max_concurrent,
+            'pending': self._pending,
+            'rounds': self.rounds,
+        }
+
+    def shutdown(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+
+password_hasher = PasswordHasher(**password_config)
@@ -0,0 +1,71 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+promotions_cache_config = {
+    # Respaldo para las promociones añadidas desde otro proceso (la app del dueño)
+    'ttl': 300
+}
+
+
+class PromotionsCache:
+    """Promociones y sus imágenes ya codificadas, compartidas por todas las sesiones del proceso.
+
+    ``add_promotion`` la invalida en el proceso que escribe; en los demás
+    procesos la entrada caduca a los ``ttl`` segundos.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._entries = None
+        self._loaded_at = 0.0
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _fresh(self):
+        return self._entries is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def get(self, loader):
+        """Devuelve las promociones en caché o las carga con ``loader()`` (una sola carga a la vez)."""
+        with self._lock:
+            if self._fresh():
+                self.hits += 1
+                return self._entries
+            self.misses += 1
+        with self._load_lock:
+            with self._lock:
+                # Otra sesión pudo cargarlas mientras se esperaba
+                if self._fresh():
+                    return self._entries
+                generation = self._generation
+            entries = loader()
+            with self._lock:
+                # Si se invalidó durante la carga, estas filas pueden estar desactualizadas
+                if generation == self._generation:
+                    self._entries = entries
+                    self._loaded_at = time.monotonic()
+            return entries
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = None
+            self._generation += 1
+        logger.info("Caché de promociones invalidada")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'cached': self._entries is not None,
+                'entries': len(self._entries or ()),
+                'age_seconds': round(time.monotonic() - self._loaded_at, 1) if self._entries is not None else None,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+promotions_cache = PromotionsCache(ttl=promotions_cache_config['ttl'])
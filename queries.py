@@ -0,0 +1,188 @@
+"""SQL de las consultas frecuentes.
+
+Lo usan tanto los métodos de las apps como el informe EXPLAIN
+(``migrations.HOT_QUERIES``), de modo que el informe analiza exactamente las
+sentencias que se ejecutan. Las consultas con partes opcionales se construyen
+con funciones que devuelven ``(sql, params)``.
+"""
+from datetime import timedelta
+
+# Saldo efectivo de días: remaining_days limitado por los días que faltan hasta el fin de la membresía
+EFFECTIVE_REMAINING_DAYS_SQL = (
+    "LEAST(remaining_days, IFNULL(GREATEST(DATEDIFF(membership_end_date, CURDATE()), 0), remaining_days))"
+)
+
+USER_BY_USERNAME_SQL = "SELECT * FROM users WHERE username = %s"
+OWNER_BY_USERNAME_SQL = "SELECT * FROM owners WHERE username = %s"
+REMAINING_DAYS_SQL = f"SELECT {EFFECTIVE_REMAINING_DAYS_SQL} AS remaining_days FROM users WHERE id = %s"
+UNREAD_COUNT_SQL = "SELECT unread_notifications FROM users WHERE id = %s"
+PROMOTIONS_SQL = "SELECT * FROM promotions ORDER BY created_at DESC"
+CACHED_PROMOTIONS_SQL = "SELECT id, title, description, image_path, created_at FROM promotions ORDER BY created_at DESC"
+PAYMENT_BY_IMAGE_SQL = ("SELECT id, user_id, status, payment_date FROM payments "
+                        "WHERE image_path = %s AND status <> 'rejected' LIMIT 1")
+PENDING_PAYMENTS_SQL = ("SELECT p.*, u.username FROM payments p JOIN users u ON p.user_id = u.id "
+                        "WHERE p.status = 'pending' ORDER BY p.payment_date DESC")
+
+MONTHLY_ATTENDANCE_COUNTS_SQL = """
+    SELECT YEAR(attendance_date) AS year, MONTH(attendance_date) AS month, COUNT(*) AS total
+    FROM attendances
+    WHERE user_id = %s AND attendance_date >= %s
+    GROUP BY YEAR(attendance_date), MONTH(attendance_date)
+    ORDER BY year DESC, month DESC
+"""
+
+# Panel del dueño: lectura de las tablas resumen (ver CommonApp.rebuild_statistics)
+STATISTICS_SQL = """
+    SELECT
+        (SELECT COALESCE(MAX(value), 0) FROM stats_counters WHERE name = 'total_users') AS total_users,
+        (SELECT COALESCE(SUM(total), 0) FROM stats_membership_expiry WHERE end_date >= CURDATE()) AS active_users,
+        (SELECT COALESCE(MAX(value), 0) FROM stats_counters WHERE name = 'total_income') AS total_income,
+        (SELECT COALESCE(SUM(total), 0) FROM stats_daily_attendance
+         WHERE day >= DATE_SUB(CURDATE(), INTERVAL 1 MONTH)) AS monthly_attendances
+"""
+
+# Tarea de vencimientos: membresías vencidas con saldo pendiente
+EXPIRED_MEMBERSHIPS_CONDITION = "membership_end_date < %s AND remaining_days > 0"
+EXPIRE_MEMBERSHIPS_SQL = f"UPDATE users SET remaining_days = 0 WHERE {EXPIRED_MEMBERSHIPS_CONDITION}"
+
+
+def _in_list(values):
+    return ", ".join(["%s"] * len(values))
+
+
+def attendance_history_query(user_id, limit=None, offset=0, start_date=None, end_date=None):
+    query = "SELECT * FROM attendances WHERE user_id = %s"
+    params = [user_id]
+    if start_date is not None:
+        query += " AND attendance_date >= %s"
+        params.append(start_date)
+    if end_date is not None:
+        query += " AND attendance_date <= %s"
+        params.append(end_date)
+    query += " ORDER BY attendance_date DESC, id DESC"
+    if limit is not None:
+        query += " LIMIT %s OFFSET %s"
+        params += [limit, offset]
+    return query, params
+
+
+def notifications_query(user_id, limit=10, before=None):
+    # Página de notificaciones sin leer, de la más reciente a la más antigua.
+    # before=(sent_at, id) de la última fila de la página anterior
+    query = "SELECT id, message, sent_at FROM notifications WHERE user_id = %s AND is_read = 0"
+    params = [user_id]
+    if before is not None:
+        query += " AND (sent_at < %s OR (sent_at = %s AND id < %s))"
+        params += [before[0], before[0], before[1]]
+    query += " ORDER BY sent_at DESC, id DESC LIMIT %s"
+    params.append(limit)
+    return query, params
+
+
+def attendance_chunks_query(after_id=0, missing_ids=()):
+    condition = "id > %s"
+    if missing_ids:
+        condition += f" OR id IN ({_in_list(missing_ids)})"
+    query = f"""
+        SELECT id, user_id, TO_DAYS(attendance_date),
+               IFNULL(WEEKDAY(attended_at) * 24 + HOUR(attended_at), -1)
+        FROM attendances
+        WHERE {condition}
+        ORDER BY id
+    """
+    return query, [after_id, *missing_ids]
+
+
+def revenue_rollup_query(since=None):
+    query = ("SELECT month, payment_type, approved_count, approved_amount, rejected_count, pending_count "
+             "FROM stats_revenue_monthly")
+    params = []
+    if since is not None:
+        query += " WHERE month >= %s"
+        params.append(since)
+    query += " ORDER BY month"
+    return query, params
+
+
+def users_page_query(after=None, limit=None, order_by="id"):
+    # after: último id visto, o (username, id) si se ordena por nombre de usuario
+    query = "SELECT id, username, membership_type, membership_end_date, remaining_days FROM users"
+    params = []
+    if order_by == "username":
+        if after is not None:
+            query += " WHERE username > %s OR (username = %s AND id > %s)"
+            params += [after[0], after[0], after[1]]
+        query += " ORDER BY username, id"
+    else:
+        if after is not None:
+            query += " WHERE id > %s"
+            params.append(after)
+        query += " ORDER BY id"
+    if limit is not None:
+        query += " LIMIT %s"
+        params.append(limit)
+    return query, params
+
+
+def payment_history_conditions(filters):
+    """Condiciones SQL y parámetros para los filtros del historial de pagos (alias p = payments, u = users).
+
+    Filtros admitidos: username (prefijo), status, payment_type, date_from,
+    date_to, amount_min y amount_max; los vacíos se ignoran.
+    """
+    conditions, params = [], []
+    filters = filters or {}
+    if filters.get('username'):
+        escaped = filters['username'].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        conditions.append("u.username LIKE %s")
+        params.append(f"{escaped}%")
+    for column in ('status', 'payment_type'):
+        if filters.get(column):
+            conditions.append(f"p.{column} = %s")
+            params.append(filters[column])
+    for key, condition in (('date_from', "p.payment_date >= %s"), ('date_to', "p.payment_date <= %s"),
+                           ('amount_min', "p.amount >= %s"), ('amount_max', "p.amount <= %s")):
+        if filters.get(key) is not None:
+            conditions.append(condition)
+            params.append(filters[key])
+    return conditions, params
+
+
+def payment_history_query(filters=None, limit=None, before=None):
+    # before=(payment_date, id) de la última fila de la página anterior
+    conditions, params = payment_history_conditions(filters)
+    if before is not None:
+        conditions.append("(p.payment_date < %s OR (p.payment_date = %s AND p.id < %s))")
+        params += [before[0], before[0], before[1]]
+    query = """
+        SELECT p.id, u.username, p.amount, p.payment_date, p.payment_type, p.status
+        FROM payments p
+        JOIN users u ON p.user_id = u.id
+    """
+    if conditions:
+        query += f" WHERE {' AND '.join(conditions)}"
+    query += " ORDER BY p.payment_date DESC, p.id DESC"
+    if limit is not None:
+        query += " LIMIT %s"
+        params.append(limit)
+    return query, params
+
+
+def membership_reminders_query(today, since, reminder_days):
+    """Socios a notificar: vencidos desde ``since`` o que vencen dentro de N días, con su mensaje."""
+    window = "(u.membership_end_date >= %s AND u.membership_end_date < %s)"
+    window_params = [since, today]
+    for days in reminder_days:
+        window += " OR (u.membership_end_date > %s AND u.membership_end_date <= %s)"
+        window_params += [since + timedelta(days=days), today + timedelta(days=days)]
+    query = f"""
+        SELECT u.id,
+               IF(u.membership_end_date < %s,
+                  CONCAT('Tu membresía expiró el ', u.membership_end_date),
+                  CONCAT('Tu membresía expira en ', DATEDIFF(u.membership_end_date, %s),
+                         IF(DATEDIFF(u.membership_end_date, %s) = 1, ' día', ' días'))) AS message
+        FROM users u
+        WHERE ({window})
+        FOR UPDATE
+    """
+    return query, [today, today, today] + window_params